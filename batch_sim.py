@@ -0,0 +1,171 @@
+__author__ = "Cam Clark"
+__organization__ = "COSC343/AIML402, University of Otago"
+__email__ = "claca067@student.otago.ac.nz"
+
+import time
+import numpy as np
+from settings import game_settings
+from xnimmt import XNimmtGame, time_to_str
+
+# Policies for the batch engine. A policy gets the engine, the batch state and the player index
+# and returns, for every game, the slot in that player's hand to play (slots with card 0 are
+# already played).
+
+def random_policy(sim, state, p, rnd):
+   hands = state.hands[:, p, :]
+   choice = rnd.random_sample(hands.shape)
+   choice[hands == 0] = -1
+   return np.argmax(choice, axis=1)
+
+def lowest_card_policy(sim, state, p, rnd):
+   hands = state.hands[:, p, :]
+   return np.argmin(np.where(hands > 0, hands, sim.num_cards_in_deck + 1), axis=1)
+
+def highest_card_policy(sim, state, p, rnd):
+   return np.argmax(state.hands[:, p, :], axis=1)
+
+
+class BatchState:
+   """State of N games held as arrays
+
+   :ivar hands: (N, players, cards in hand) card numbers, 0 for a played card
+   :ivar row_tops: (N, rows) number of the last card in each row
+   :ivar row_lengths: (N, rows) number of cards in each row
+   :ivar row_points: (N, rows) sum of the card values in each row
+   :ivar scores: (N, players) points taken so far (negative, like XNimmtGame.play)
+   """
+
+   def __init__(self, hands, row_tops, row_lengths, row_points, scores):
+      self.hands = hands
+      self.row_tops = row_tops
+      self.row_lengths = row_lengths
+      self.row_points = row_points
+      self.scores = scores
+
+   @property
+   def num_games(self):
+      return len(self.hands)
+
+
+class BatchXNimmt:
+   """Plays many games of X Nimmt! at once, one trick for all games per step
+
+   Follows the same rules and tie breaking as xnimmt.table_resolve, so for the same decks and
+   choices the scores match XNimmtGame.play.
+   """
+
+   def __init__(self, num_players, num_rows, num_cards_in_deck, max_cards_in_hand, xth_card_takes):
+      game = XNimmtGame(num_players=num_players, num_rows=num_rows, num_cards_in_deck=num_cards_in_deck,
+                        max_cards_in_hand=max_cards_in_hand, xth_card_takes=xth_card_takes, verbose=0)
+      self.game = game
+      self.num_players = num_players
+      self.num_rows = num_rows
+      self.num_cards_in_deck = num_cards_in_deck
+      self.max_cards_in_hand = max_cards_in_hand
+      self.xth_card_takes = xth_card_takes
+
+      # Card values indexed by card number, 0 is not a card
+      self.card_points = np.zeros(num_cards_in_deck + 1, dtype='int')
+      for n, value in game.deck:
+         self.card_points[n] = value
+
+   def deal(self, decks):
+      """Deals the games the same way XNimmtGame.play does
+
+      :param decks: (N, cards in deck) indices into the deck, as from XNimmtGame.deal_decks
+      """
+      decks = np.asarray(decks) + 1 # index i is card number i+1
+      N = len(decks)
+      H = self.max_cards_in_hand
+      P = self.num_players
+
+      hands = np.sort(decks[:, :P*H].reshape(N, P, H), axis=2)
+      row_tops = np.sort(decks[:, P*H:P*H+self.num_rows], axis=1)
+      row_lengths = np.ones((N, self.num_rows), dtype='int')
+      row_points = self.card_points[row_tops]
+      scores = np.zeros((N, P))
+      return BatchState(hands, row_tops, row_lengths, row_points, scores)
+
+   def resolve_trick(self, state, cards):
+      """Places one card per player in every game, lowest card first
+
+      :param cards: (N, players) card numbers played
+      """
+      N = state.num_games
+      games = np.arange(N)
+      order = np.argsort(cards, axis=1)
+      big = self.num_cards_in_deck + 1
+
+      for k in range(self.num_players):
+         player = order[:, k]
+         card = cards[games, player]
+
+         diff = card[:, None] - state.row_tops
+         fits = diff > 0
+         closest = np.argmin(np.where(fits, diff, big), axis=1)
+         can_place = fits.any(axis=1)
+
+         # Rows that can't take the card fall back on the row with the least points
+         r = np.where(can_place, closest, np.argmin(state.row_points, axis=1))
+         take = ~can_place | (state.row_lengths[games, r] >= self.xth_card_takes)
+
+         state.scores[games, player] -= np.where(take, state.row_points[games, r], 0)
+
+         value = self.card_points[card]
+         state.row_tops[games, r] = card
+         state.row_lengths[games, r] = np.where(take, 1, state.row_lengths[games, r] + 1)
+         state.row_points[games, r] = np.where(take, value, state.row_points[games, r] + value)
+
+   def play(self, policies, decks=None, num_games=1000, seed=None):
+      """Plays a full game in every deck
+
+      :param policies: one policy function per player
+      :param decks: (N, cards in deck) indices into the deck (e.g. from XNimmtGame.deal_decks to
+                    replay the same games), shuffled here from seed if None
+      :return: (N, players) scores of every game
+      """
+      if len(policies) != self.num_players:
+         raise RuntimeError("Error! Need one policy per player")
+
+      if seed is None:
+         seed = int(time.time())
+      rnd = np.random.RandomState(seed)
+
+      if decks is None:
+         decks = np.argsort(rnd.random_sample((num_games, len(self.game.deck))), axis=1)
+
+      state = self.deal(decks)
+      games = np.arange(state.num_games)
+
+      for _ in range(self.max_cards_in_hand):
+         cards = np.zeros((state.num_games, self.num_players), dtype='int')
+         for p, policy in enumerate(policies):
+            slot = policy(self, state, p, rnd)
+            cards[:, p] = state.hands[games, p, slot]
+            state.hands[games, p, slot] = 0
+
+         if np.any(cards == 0):
+            raise RuntimeError("Error! A policy picked a card that was already played")
+
+         self.resolve_trick(state, cards)
+
+      return state.scores
+
+
+if __name__ == "__main__":
+
+   sim = BatchXNimmt(num_players=len(game_settings['players']),
+                     num_rows=game_settings['numRows'],
+                     num_cards_in_deck=game_settings['numCardsInDeck'],
+                     max_cards_in_hand=game_settings['maxCardsInHand'],
+                     xth_card_takes=game_settings['XthCardTakes'])
+
+   num_games = 100000
+   policies = [random_policy] * sim.num_players
+   start = time.time()
+   scores = sim.play(policies, num_games=num_games, seed=game_settings['seed'])
+   elapsed = time.time() - start
+
+   print("Batch of %d random games in %s (%.0f games/s)" % (num_games, time_to_str(elapsed), num_games / elapsed))
+   for p in range(sim.num_players):
+      print("  Player %d: average score %.2f" % (p+1, scores[:, p].mean()))
@@ -0,0 +1,237 @@
+__author__ = "Cam Clark"
+__organization__ = "COSC343/AIML402, University of Otago"
+__email__ = "claca067@student.otago.ac.nz"
+
+# Throughput benchmarks for the game engine and the agents, with fixed seeds and deck
+# configurations so that results from different commits can be compared. Prints (or writes)
+# the results as JSON, e.g.
+#
+#    python benchmark.py --output bench.json
+#    python benchmark.py --quick --configs default
+#
+# --verify first checks that Table.resolve and Table.undo give exactly what table_resolve does
+# on random play, and stops with an error if they don't.
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import numpy as np
+from xnimmt import XNimmtGame, Player, table_resolve, table_resolve_inplace, table_undo, Table
+
+# name: (numCardsInDeck, maxCardsInHand, XthCardTakes, numRows, my_agent search depth)
+# The agent runs at a fixed depth without a time budget, so it does the same work every run:
+# expectimax on every move (no opening book or sampling), and the exact endgame only once the
+# cards left in hand are within the search depth.
+CONFIGS = {
+   "default": (17, 5, 4, 3, 3),
+   "medium": (34, 8, 5, 4, 2),
+   "large": (104, 10, 6, 4, 1),
+}
+
+SEED = 1
+
+
+def make_game(config, num_players=2):
+   num_cards_in_deck, max_cards_in_hand, xth_card_takes, num_rows, _ = CONFIGS[config]
+   return XNimmtGame(num_players=num_players, num_rows=num_rows, num_cards_in_deck=num_cards_in_deck,
+                     max_cards_in_hand=max_cards_in_hand, xth_card_takes=xth_card_takes, verbose=0)
+
+
+def resolve_positions(game, num_positions, seed=SEED):
+   """Table and card pairs seen when playing random cards, for timing table_resolve"""
+   rnd = random.Random(seed)
+   positions = []
+   while len(positions) < num_positions:
+      deck = list(game.deck)
+      rnd.shuffle(deck)
+      table = [[deck.pop()] for _ in range(game.num_rows)]
+      table.sort(key=lambda x: x[0][0])
+      for card in deck:
+         positions.append(([list(row) for row in table], card))
+         table, _, _ = table_resolve(table, card, game.xth_card_takes)
+         if len(positions) == num_positions:
+            break
+   return positions
+
+
+def bench_resolve(game, num_positions):
+   positions = resolve_positions(game, num_positions)
+   xth = game.xth_card_takes
+   results = {}
+
+   start = time.perf_counter()
+   for table, card in positions:
+      table_resolve(table, card, xth)
+   results["table_resolve_calls_per_s"] = num_positions / (time.perf_counter() - start)
+
+   start = time.perf_counter()
+   for table, card in positions:
+      _, _, undo = table_resolve_inplace(table, card, xth)
+      table_undo(table, undo)
+   results["table_resolve_inplace_calls_per_s"] = num_positions / (time.perf_counter() - start)
+
+   tables = [(Table(table), card) for table, card in positions]
+   start = time.perf_counter()
+   for table, card in tables:
+      _, _, undo = table.resolve(card, xth)
+      table.undo(undo)
+   results["Table_resolve_calls_per_s"] = num_positions / (time.perf_counter() - start)
+
+   return results
+
+
+def check_table(table, reference):
+   """Raises RuntimeError if table is not the reference rows with its kept values up to date"""
+   rows = [list(row) for row in reference]
+   tops = [row[-1][0] for row in rows]
+   points = [sum(c[1] for c in row) for row in rows]
+   if (table.as_lists() != rows or table.tops != tops or table.lengths != [len(row) for row in rows]
+       or table.points != points or table.sorted_tops != sorted(tops)
+       or [tops[r] for r in table.order] != table.sorted_tops
+       or table.least_points_row() != points.index(min(points))):
+      raise RuntimeError("Table %s does not match table_resolve's %s" % (vars(table), rows))
+
+
+def verify_table(num_games=2000, seed=SEED):
+   """Property check of Table against table_resolve_inplace on random decks, tables and cards:
+   every placement gives the same points, row and rows, and undoing any number of
+   placements gives back the same table. Returns the number of placements checked."""
+   rnd = random.Random(seed)
+   checked = 0
+   for _ in range(num_games):
+      num_rows = rnd.randint(1, 6)
+      xth_card_takes = rnd.randint(1, 7)
+      num_cards = rnd.randint(num_rows + 1, 60)
+      deck = [(n, rnd.randint(1, 7)) for n in range(1, num_cards + 1)]
+      rnd.shuffle(deck)
+      reference = [[deck.pop()] for _ in range(num_rows)]
+      if rnd.random() < 0.5:
+         reference.sort(key=lambda x: x[0][0]) # as dealt by the game, but any order works
+      table = Table(reference)
+      history = []
+      for card in deck:
+         snapshot = [list(row) for row in reference]
+         expected = table_resolve_inplace(reference, card, xth_card_takes)
+         points, r, undo = table.resolve(card, xth_card_takes)
+         if (points, r) != expected[:2]:
+            raise RuntimeError("Table.resolve(%s) gave %s, table_resolve %s" % (card, (points, r), expected[:2]))
+         check_table(table, reference)
+         history.append((snapshot, undo))
+         checked += 1
+
+         if history and rnd.random() < 0.2:
+            # Undo a few placements and check the table is back where it was
+            for _ in range(rnd.randint(1, len(history))):
+               snapshot, undo = history.pop()
+               table.undo(undo)
+               reference = snapshot
+               check_table(table, reference)
+   return checked
+
+
+def timed_agents(players):
+   """Wraps every player's AgentFunction to record its latency, returns the per-player lists"""
+   latencies = []
+   for player in players:
+      times = []
+      function = player.agent.AgentFunction
+      def timed(percepts, function=function, times=times):
+         start = time.perf_counter()
+         action = function(percepts)
+         times.append(time.perf_counter() - start)
+         return action
+      player.agent.AgentFunction = timed
+      latencies.append(times)
+   return latencies
+
+
+def bench_play(game, agentFiles, num_games, search_depth):
+   players = [Player(game=game, playerFile=agentFile) for agentFile in agentFiles]
+   for player in players:
+      if hasattr(player.agent, 'fixed_depth'):
+         player.agent.fixed_depth(search_depth)
+   latencies = timed_agents(players)
+
+   all_decks, game_seeds = game.deal_decks(num_games, SEED)
+   start = time.perf_counter()
+   for n in range(num_games):
+      game.play_seeded(players, all_decks[n].tolist(), game_seeds[n])
+   elapsed = time.perf_counter() - start
+
+   result = {"players": list(agentFiles), "games": num_games, "games_per_s": num_games / elapsed}
+   agents = []
+   for player, times in zip(players, latencies):
+      times = np.array(times) if times else np.zeros(1)
+      stats = {"agent": player.playerFile,
+               "decisions": len(times),
+               "decisions_per_s": len(times) / max(times.sum(), 1e-12),
+               "latency_p50_ms": float(np.percentile(times, 50) * 1000),
+               "latency_p99_ms": float(np.percentile(times, 99) * 1000),
+               "latency_max_ms": float(times.max() * 1000)}
+      if hasattr(player.agent, 'search_mode'):
+         stats["search_mode"] = player.agent.search_mode
+         stats["endgame_cards"] = player.agent.endgame_cards
+      if hasattr(player.agent, 'nodes'):
+         stats["nodes"] = player.agent.nodes
+         stats["nodes_per_s"] = player.agent.nodes / max(times.sum(), 1e-12)
+      agents.append(stats)
+   result["agents"] = agents
+   return result
+
+
+def git_commit():
+   """Commit of the repository benchmark.py is in, wherever it is run from"""
+   try:
+      return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True,
+                                     cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+   except Exception:
+      return None
+
+
+def run_benchmarks(configs, quick=False):
+   scale = 10 if quick else 1
+   report = {"commit": git_commit(),
+             "python": platform.python_version(),
+             "numpy": np.__version__,
+             "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+             "seed": SEED,
+             "configs": {}}
+
+   for config in configs:
+      num_cards_in_deck, max_cards_in_hand, xth_card_takes, num_rows, search_depth = CONFIGS[config]
+      game = make_game(config)
+      entry = {"numCardsInDeck": num_cards_in_deck, "maxCardsInHand": max_cards_in_hand,
+               "XthCardTakes": xth_card_takes, "numRows": num_rows, "search_depth": search_depth}
+      entry["resolve"] = bench_resolve(game, 200000 // scale)
+      entry["play"] = [bench_play(game, ("random_agent.py", "random_agent.py"), 2000 // scale, search_depth),
+                       bench_play(game, ("my_agent.py", "random_agent.py"), max(2, 20 // scale), search_depth)]
+      report["configs"][config] = entry
+
+   return report
+
+
+if __name__ == "__main__":
+
+   parser = argparse.ArgumentParser(description="Benchmark the X Nimmt! engine and agents")
+   parser.add_argument("--configs", nargs="+", choices=sorted(CONFIGS), default=list(CONFIGS),
+                       help="deck configurations to run")
+   parser.add_argument("--quick", action="store_true", help="run a tenth of the games and calls")
+   parser.add_argument("--output", help="write the JSON report to this file instead of printing it")
+   parser.add_argument("--verify", action="store_true", help="check Table against table_resolve first")
+   args = parser.parse_args()
+
+   if args.verify:
+      print("Table matches table_resolve on %d placements" % verify_table(200 if args.quick else 2000), file=sys.stderr)
+
+   report = run_benchmarks(args.configs, quick=args.quick)
+   if args.output:
+      with open(args.output, "w") as f:
+         json.dump(report, f, indent=1)
+   else:
+      json.dump(report, sys.stdout, indent=1)
+      print()
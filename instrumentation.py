@@ -0,0 +1,118 @@
+__author__ = "Cam Clark"
+__organization__ = "COSC343/AIML402, University of Otago"
+__email__ = "claca067@student.otago.ac.nz"
+
+# Per-move instrumentation for XNimmtGame.play. Attach it to a game before playing:
+#
+#    game.instrument = Instrumentation()
+#    game.run(agentFiles=..., num_games=...)
+#    game.instrument.dump("trace.json")
+#
+# Agents can report their own counters (nodes expanded, prunes, cache hits, depth reached...)
+# by having an instrument_hook attribute. The game then sets it to a function
+# hook(name, value) for the duration of each AgentFunction call, and leaves it None otherwise.
+
+import json
+import math
+import time
+
+# Latency histogram buckets are powers of two in microseconds: bucket b holds times in
+# [2^(b-1), 2^b) us, bucket 0 anything under 1 us
+NUM_BUCKETS = 32
+
+
+def latency_bucket(seconds):
+   us = seconds * 1e6
+   if us < 1:
+      return 0
+   return min(NUM_BUCKETS - 1, int(math.log2(us)) + 1)
+
+
+class Instrumentation:
+   """Times every AgentFunction call and collects what agents report through instrument_hook
+
+   :param keep_moves: keep a record of every move for the trace, otherwise only the histograms
+                      and totals are kept
+   """
+
+   def __init__(self, keep_moves=True):
+      self.keep_moves = keep_moves
+      self.moves = []
+      self.games = []
+      self.agents = {} # player index -> per-agent totals and histogram
+      self.game_index = -1
+      self.game_start = None
+      self._counters = None
+
+   def begin_game(self, players):
+      self.game_index += 1
+      self.game_start = time.perf_counter()
+      for p, player in enumerate(players):
+         if p not in self.agents:
+            self.agents[p] = {"name": player.name, "file": player.playerFile, "moves": 0, "time": 0.0,
+                              "max_time": 0.0, "histogram": [0] * NUM_BUCKETS, "counters": {}}
+
+   def end_game(self, scores):
+      self.games.append({"game": self.game_index, "time": time.perf_counter() - self.game_start,
+                         "scores": [float(s) for s in scores]})
+
+   def report(self, name, value):
+      """The hook agents call: counters add up over the move, other values are kept as given"""
+      if isinstance(value, (int, float)) and not isinstance(value, bool) and name in self._counters:
+         self._counters[name] += value
+      else:
+         self._counters[name] = value
+
+   def call_agent(self, p, player, percepts):
+      agent = player.agent
+      hooked = hasattr(agent, 'instrument_hook')
+      self._counters = {}
+      if hooked:
+         agent.instrument_hook = self.report
+      start = time.perf_counter()
+      try:
+         action = agent.AgentFunction(percepts)
+      finally:
+         elapsed = time.perf_counter() - start
+         if hooked:
+            agent.instrument_hook = None
+      counters = self._counters
+      self._counters = None
+
+      stats = self.agents[p]
+      stats["moves"] += 1
+      stats["time"] += elapsed
+      stats["max_time"] = max(stats["max_time"], elapsed)
+      stats["histogram"][latency_bucket(elapsed)] += 1
+      for name, value in counters.items():
+         if isinstance(value, (int, float)) and not isinstance(value, bool):
+            stats["counters"][name] = stats["counters"].get(name, 0) + value
+
+      self.record_move(p, player, percepts, action, elapsed, counters)
+      return action
+
+   def record_move(self, p, player, percepts, action, elapsed, counters):
+      """Keeps one move of the trace, subclasses can override it to record more (e.g. the percepts)"""
+      if self.keep_moves:
+         self.moves.append({"game": self.game_index, "player": p,
+                            "hand_size": len(percepts[0]), "action": action, "time": elapsed,
+                            "counters": counters})
+
+   def summary(self):
+      """Per-agent totals, numbers agents reported are summed over their moves (divide by
+      moves for a mean, e.g. of depth reached)"""
+      agents = {}
+      for p, stats in self.agents.items():
+         summary = dict(stats)
+         summary["mean_time"] = stats["time"] / max(1, stats["moves"])
+         summary["histogram_bucket_us"] = [0] + [2 ** b for b in range(NUM_BUCKETS - 1)]
+         agents[str(p)] = summary
+      return {"games": len(self.games), "agents": agents}
+
+   def trace(self):
+      return {"summary": self.summary(), "games": self.games, "moves": self.moves}
+
+   def dump(self, path):
+      """Writes the summary, per-game times and scores and every kept move as JSON"""
+      with open(path, "w") as f:
+         json.dump(self.trace(), f)
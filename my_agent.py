@@ -5,8 +5,500 @@ __email__ = "claca067@student.otago.ac.nz"
 
 agentName = "CamAIAgent"
 
-from xnimmt import table_resolve
-import copy
+from abc import ABC, abstractmethod
+from collections import namedtuple, OrderedDict
+import itertools
+import math
+import multiprocessing
+import os
+import queue
+import random
+import time
+import traceback
+import weakref
+import numpy as np
+
+# Compact, hashable search state.
+# rows   : tuple of rows, each a (top card number, number of cards, points in row) tuple
+# hand   : bitmask of my card numbers (bit n set means card n is in hand)
+# unseen : bitmask of card numbers the opponent could still play
+SearchState = namedtuple("SearchState", ["rows", "hand", "unseen"])
+
+def card_bits(mask):
+    """Yields the card numbers set in a bitmask, lowest first"""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+def rows_resolve(rows, card, points, xth_card_takes):
+    """
+    Same rules as xnimmt.table_resolve but on a tuple of (top, length, points) rows,
+    so a placement is O(1) per row no matter how long the rows are.
+    :param points: list of card values indexed by card number
+    :return: (new rows, points taken as a negative number, row index)
+    """
+    select_row = None
+    card_diff = None
+    for r, row in enumerate(rows):
+        top = row[0]
+        if top < card and (select_row is None or card - top < card_diff):
+            card_diff = card - top
+            select_row = r
+
+    if select_row is not None:
+        r = select_row
+        top, length, row_points = rows[r]
+        if length < xth_card_takes:
+            return rows[:r] + ((card, length + 1, row_points + points[card]),) + rows[r+1:], 0, r
+    else:
+        # No rows available, take the row with the least points (first one on a tie like np.argmin)
+        row_points = [row[2] for row in rows]
+        r = row_points.index(min(row_points))
+
+    return rows[:r] + ((card, 1, points[card]),) + rows[r+1:], -rows[r][2], r
+
+def rows_resolve_trick(rows, cards, points, xth_card_takes):
+    """
+    Places a whole trick in one call, cards must be in ascending order (the order the game
+    places them in).
+    :return: (new rows, list of points taken as negative numbers by each card in cards)
+    """
+    taken = []
+    for card in cards:
+        rows, pts, _ = rows_resolve(rows, card, points, xth_card_takes)
+        taken.append(pts)
+    return rows, taken
+
+
+class SearchTimeout(Exception):
+    """Raised inside the search when the per-move time budget runs out"""
+
+
+class TranspositionTable:
+    """
+    Bounded cache of expectimax results keyed on (state, card, remaining depth), the state
+    and card in the reduced form of XNimmtAgent.canonical_key for deep enough nodes.
+
+    Entries are either EXACT values or LOWER bounds (a branch that was pruned, its real
+    value is at least the stored one). When full the least recently used entry is evicted
+    ("lru"), or the shallowest of the few least recently used ones ("depth") so the
+    expensive deep results stay around longer.
+    """
+    EXACT = 0
+    LOWER = 1
+
+    def __init__(self, max_entries=200000, policy="lru", depth_window=8):
+        if policy not in ("lru", "depth"):
+            raise ValueError("policy must be 'lru' or 'depth'")
+        self.max_entries = max_entries
+        self.policy = policy
+        self.depth_window = depth_window # how many of the oldest entries the depth policy looks at
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+
+    def lookup(self, key, pruning):
+        """
+        Returns (value, exact) if the stored value is usable under the current pruning bound, else None.
+        A LOWER bound is only usable if it already reaches the bound (the branch gets pruned again).
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            value, flag = entry
+            if flag == self.EXACT or value >= pruning:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value, flag == self.EXACT
+        self.misses += 1
+        return None
+
+    def store(self, key, value, flag):
+        entries = self.entries
+        if key in entries:
+            old_value, old_flag = entries[key]
+            if old_flag == self.EXACT and flag == self.LOWER:
+                return # never overwrite an exact value with a bound
+            entries[key] = (value, flag)
+            entries.move_to_end(key)
+            return
+        if len(entries) >= self.max_entries:
+            self._evict()
+        entries[key] = (value, flag)
+
+    def _evict(self):
+        if self.policy == "lru":
+            self.entries.popitem(last=False)
+        else:
+            # key[-1] is the remaining depth, drop the shallowest of the oldest entries
+            oldest = []
+            for key in self.entries:
+                oldest.append(key)
+                if len(oldest) == self.depth_window:
+                    break
+            del self.entries[min(oldest, key=lambda k: k[-1])]
+        self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+class RootSearchPool:
+    """
+    Persistent worker processes that each search one root card at a time.
+
+    Every worker has its own XNimmtAgent (and transposition table). The best exact root score
+    found so far is kept in shared memory and read by the workers at every reply of their root
+    card, so cards searched later are still pruned against it. Needs the "fork" start method, agent
+    modules are loaded from file by the game and can't be re-imported by spawned processes.
+    """
+
+    def __init__(self, agent_args, num_workers, agent_settings=None):
+        ctx = multiprocessing.get_context("fork")
+        self.bound = ctx.RawValue("d", float("inf"))
+        self.bound_lock = ctx.Lock()
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.agent_settings = agent_settings or {}
+        self.workers = []
+        for _ in range(num_workers):
+            worker = ctx.Process(target=_root_worker_loop, daemon=True,
+                                 args=(self.tasks, self.results, agent_args, agent_settings or {}, self.bound, self.bound_lock))
+            worker.start()
+            self.workers.append(worker)
+        self._finalizer = weakref.finalize(self, _stop_root_workers, self.tasks, self.workers)
+
+    @staticmethod
+    def available():
+        # daemon processes (e.g. XNimmtGame.run workers) are not allowed to start their own
+        return "fork" in multiprocessing.get_all_start_methods() and not multiprocessing.current_process().daemon
+
+    def search(self, state, order, depth, budget, bound):
+        """
+        Searches every card in order at the given depth.
+        :param budget: seconds the workers have, None for no limit
+        :param bound: best root score found so far, None to search every card without pruning
+        :return: dict of card -> (score, exact), or None if a worker ran out of time
+        """
+        pruning = bound is not None
+        self.bound.value = bound if pruning else float("inf")
+        for card in order:
+            self.tasks.put((tuple(state.rows), state.hand, state.unseen, card, depth, budget, pruning))
+        results = {}
+        timed_out = False
+        error = None
+        for _ in order:
+            while True:
+                try:
+                    card, score, exact, worker_timed_out, worker_error = self.results.get(timeout=1.0)
+                    break
+                except queue.Empty:
+                    if not all(worker.is_alive() for worker in self.workers):
+                        # A worker that died never answers, the pool can't be used any more
+                        self.close()
+                        raise RuntimeError("Error! A root search worker stopped")
+            results[card] = (score, exact)
+            timed_out = timed_out or worker_timed_out
+            error = error or worker_error
+        if error is not None:
+            raise RuntimeError("Error! Root search worker failed:\n" + error)
+        return None if timed_out else results
+
+    def close(self):
+        self._finalizer()
+
+
+def _stop_root_workers(tasks, workers):
+    """Stops the workers of a RootSearchPool, on close or when the pool is garbage collected"""
+    for worker in workers:
+        if worker.is_alive():
+            tasks.put(None)
+    for worker in workers:
+        worker.join(timeout=5.0)
+        if worker.is_alive():
+            worker.terminate()
+    workers.clear()
+
+
+def _root_worker_loop(tasks, results, agent_args, agent_settings, bound, bound_lock):
+    agent = XNimmtAgent(*agent_args)
+    for name, value in agent_settings.items():
+        setattr(agent, name, value)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        rows, hand, unseen, card, depth, budget, pruning = task
+        if bin(hand).count("1") == agent.max_cards_in_hand:
+            agent.canonical_cache.clear() # first move of a game
+        agent.shared_bound = bound if pruning else None
+        agent.deadline = None if budget is None else time.perf_counter() + budget
+        try:
+            score, exact = agent._expectimax(SearchState(rows, hand, unseen), card, depth,
+                                             bound.value if pruning else float("inf"), root=True)
+        except SearchTimeout:
+            results.put((card, None, False, True, None))
+            continue
+        except Exception:
+            # Sent back and raised by RootSearchPool.search, the game waits for every card
+            results.put((card, None, False, False, traceback.format_exc()))
+            continue
+        finally:
+            agent.deadline = None
+        if exact and pruning:
+            with bound_lock:
+                if score < bound.value:
+                    bound.value = score
+        results.put((card, score, exact, False, None))
+
+
+class OpeningBook:
+    """
+    First moves precomputed by opening_book.py for one deck configuration.
+
+    The file is a sorted numpy array of (key, card) records, memory-mapped on first use so
+    loading it costs nothing until a game actually starts. A missing file just means no book.
+    """
+    DTYPE = np.dtype([("key", "<u8"), ("card", "u1")])
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = None
+        self.loaded = False
+
+    @staticmethod
+    def file_name(num_cards_in_deck, max_cards_in_hand, xth_card_takes, num_rows):
+        return "opening_book_%d_%d_%d_%d.npy" % (num_cards_in_deck, max_cards_in_hand, xth_card_takes, num_rows)
+
+    @staticmethod
+    def key(state, num_cards_in_deck):
+        """
+        Opening positions are the hand and the row tops (every row has one card and the rest
+        of the cards are unseen), packed as two bitmasks in one 64 bit key.
+        """
+        tops = 0
+        for row in state.rows:
+            tops |= 1 << row[0]
+        return state.hand | (tops << (num_cards_in_deck + 1))
+
+    @staticmethod
+    def fits(num_cards_in_deck):
+        return 2 * (num_cards_in_deck + 1) <= 64
+
+    def lookup(self, key):
+        if not self.loaded:
+            self.loaded = True
+            if os.path.exists(self.path):
+                self.entries = np.load(self.path, mmap_mode="r")
+        if self.entries is None or len(self.entries) == 0:
+            return None
+        keys = self.entries["key"]
+        i = int(np.searchsorted(keys, key))
+        if i < len(keys) and int(keys[i]) == key:
+            return int(self.entries["card"][i])
+        return None
+
+
+class OpponentModel:
+    """
+    Learns over a session how likely the opponent is to play a card, from the cards it played in
+    earlier games. A card is described by the trick (cards left in hand), where it would land
+    (below every row top so it takes a row, on a full row so it takes that row, or safely) and
+    which quarter of the unseen cards it is in. For every feature the model counts how often the opponent played a card with it
+    against how often it would have by picking uniformly, so an opponent that plays at random
+    keeps all weights near 1.
+
+    Plays seen during a game are only added at the end of it (commit), so the weights and any
+    search results cached on them don't change in the middle of a game.
+    """
+
+    def __init__(self, xth_card_takes, alpha=2.0, threshold=0.02):
+        """
+        :param alpha: prior count that pulls every weight towards 1 until enough plays are seen
+        :param threshold: replies with a lower probability than this are left out of the search
+        """
+        self.xth_card_takes = xth_card_takes
+        self.alpha = alpha
+        self.threshold = threshold
+        self.plays = {} # feature -> times the opponent played a card with it
+        self.chances = {} # feature -> times a uniform pick would have (sum of fractions)
+        self.pending = [] # (state, card played) of the current game
+        self.games = 0
+
+    def features(self, rows, cards, hand_size):
+        """Feature of every card, cards in ascending order"""
+        by_top = sorted(rows)
+        last = len(by_top) - 1
+        below = -1
+        quarter = max(1, (len(cards) + 3) // 4)
+        features = []
+        for i, card in enumerate(cards):
+            while below < last and by_top[below + 1][0] < card:
+                below += 1
+            if below < 0:
+                landing = 0 # lower than every top
+            elif by_top[below][1] >= self.xth_card_takes:
+                landing = 1 # takes a full row
+            else:
+                landing = 2
+            features.append((hand_size, landing, i // quarter))
+        return features
+
+    def observe(self, state, card):
+        """The opponent played card in the trick that started from state"""
+        self.pending.append((state, card))
+
+    def commit(self):
+        for (rows, hand, unseen), card in self.pending:
+            cards = list(card_bits(unseen | (1 << card)))
+            features = self.features(rows, cards, bin(hand).count("1"))
+            share = 1.0 / len(cards)
+            for feature in features:
+                self.chances[feature] = self.chances.get(feature, 0.0) + share
+            played = features[cards.index(card)]
+            self.plays[played] = self.plays.get(played, 0) + 1
+        if self.pending:
+            self.games += 1
+        self.pending = []
+
+    def reply_weights(self, rows, hand, unseen):
+        """
+        (buckets, total weight) of the opponent's replies for resolve_replies, replies below the
+        threshold probability left out
+        """
+        cards = list(card_bits(unseen))
+        alpha = self.alpha
+        weights = [(self.plays.get(feature, 0) + alpha) / (self.chances.get(feature, 0.0) + alpha)
+                   for feature in self.features(rows, cards, bin(hand).count("1"))]
+        cutoff = self.threshold * sum(weights)
+        buckets = [(card, weight) for card, weight in zip(cards, weights) if weight >= cutoff]
+        if not buckets: # keep the likeliest reply
+            weight, card = max(zip(weights, cards))
+            buckets = [(card, weight)]
+        return buckets, sum(weight for card, weight in buckets)
+
+
+class Evaluator(ABC):
+    """
+    Interface of XNimmtAgent.evaluator: estimates of the penalty still to come (positive, lower is
+    better) for search states. The search gives all the leaves below one node to evaluate_batch
+    at once. Subclasses have to define evaluate_batch, or can't be created.
+
+    Values must never be negative, the pruning relies on it. An evaluator whose values depend
+    only on the order of the card numbers, not on the numbers themselves, sets order_only: the
+    search then caches values under XNimmtAgent.canonical_key, which renumbers the cards keeping
+    their order, so states that differ only in their numbering share a value. Otherwise (e.g. a
+    table looked up by the row tops) the search caches on the states as they are.
+    """
+    order_only = False
+
+    def evaluate(self, agent, state):
+        return self.evaluate_batch(agent, [state])[0]
+
+    @abstractmethod
+    def evaluate_batch(self, agent, states):
+        """:return: list of the value of every state"""
+
+
+class LinearEvaluator(Evaluator):
+    """
+    Linear model over table and hand features, a whole batch of states is one matrix product.
+    Features (rows ordered by top card, so the order of the rows on the table doesn't matter):
+    points, length and points of rows one card from taking for every row, least row points,
+    chance an unseen card is below every top times least row points, share of my hand below
+    every top times least row points, cards in hand, and a constant.
+
+    The default weights only count the two forced take terms, fit_selfplay fits them to games
+    written by selfplay.py.
+    """
+    order_only = True # the features only compare card numbers
+
+    def __init__(self, num_rows, xth_card_takes, weights=None):
+        self.num_rows = num_rows
+        self.xth_card_takes = xth_card_takes
+        num_features = 3 * num_rows + 5
+        if weights is None:
+            weights = np.zeros(num_features)
+            weights[3 * num_rows + 1] = 1.0 # unseen forced take
+            weights[3 * num_rows + 2] = 1.0 # my forced take
+        self.weights = np.asarray(weights, dtype=float)
+        if len(self.weights) != num_features:
+            raise ValueError("LinearEvaluator needs %d weights for %d rows" % (num_features, num_rows))
+
+    def feature_matrix(self, tops, lengths, points, hand_size, hand_below, unseen_count, unseen_below):
+        """
+        Features of a batch from arrays: tops, lengths, points (states, rows), the rest (states,)
+        with hand_below and unseen_below the cards lower than every top.
+        """
+        order = np.argsort(tops, axis=1)
+        lengths = np.take_along_axis(lengths, order, axis=1).astype(float)
+        points = np.take_along_axis(points, order, axis=1).astype(float)
+        danger = points * (lengths >= self.xth_card_takes - 1)
+        least = points.min(axis=1)
+        unseen_forced = least * unseen_below / np.maximum(unseen_count, 1)
+        my_forced = least * hand_below / np.maximum(hand_size, 1)
+        return np.column_stack([points, lengths, danger, least, unseen_forced, my_forced,
+                                hand_size, np.ones(len(least))])
+
+    def features(self, states):
+        rows = np.array([state.rows for state in states]) # (states, rows, 3)
+        tops = rows[:, :, 0]
+        min_tops = tops.min(axis=1).tolist()
+        hand_size = []
+        hand_below = []
+        unseen_count = []
+        unseen_below = []
+        for state, min_top in zip(states, min_tops):
+            below = (1 << min_top) - 1
+            hand_size.append(bin(state.hand).count("1"))
+            hand_below.append(bin(state.hand & below).count("1"))
+            unseen_count.append(bin(state.unseen).count("1"))
+            unseen_below.append(bin(state.unseen & below).count("1"))
+        return self.feature_matrix(tops, rows[:, :, 1], rows[:, :, 2], np.array(hand_size), np.array(hand_below),
+                                   np.array(unseen_count), np.array(unseen_below))
+
+    def evaluate_batch(self, agent, states):
+        return np.maximum(self.features(states) @ self.weights, 0.0).tolist()
+
+    def fit_selfplay(self, directory, max_records=1000000, seed=0):
+        """
+        Least squares fit of the weights to the positions in a selfplay.py directory. The target is
+        the player's penalty for the whole game, which also has the points taken before the
+        position, but leaves compared by the search are at the same point of the game.
+        :return: the root mean squared error of the fit
+        """
+        from selfplay import open_dataset
+        X = []
+        y = []
+        for meta, columns in open_dataset(directory):
+            hand = np.asarray(columns["hand"])
+            tops = np.asarray(columns["row_tops"]).astype(int)
+            min_tops = tops.min(axis=1)
+            seen = np.unpackbits(np.asarray(columns["seen"]), axis=1, bitorder="little")
+            num_cards = meta["settings"]["num_cards_in_deck"]
+            unseen = 1 - seen[:, :num_cards + 1]
+            unseen[:, 0] = 0 # there is no card 0
+            below_count = np.cumsum(unseen, axis=1) # unseen cards up to each number
+            X.append(self.feature_matrix(tops, np.asarray(columns["row_lengths"]), np.asarray(columns["row_points"]),
+                                         (hand > 0).sum(axis=1), ((hand > 0) & (hand < min_tops[:, None])).sum(axis=1),
+                                         unseen.sum(axis=1), below_count[np.arange(len(tops)), min_tops - 1]))
+            y.append(-np.asarray(columns["final_score"], dtype=float))
+        X = np.concatenate(X)
+        y = np.concatenate(y)
+        if len(y) > max_records:
+            keep = np.random.RandomState(seed).choice(len(y), max_records, replace=False)
+            X, y = X[keep], y[keep]
+        self.weights = np.linalg.lstsq(X, y, rcond=None)[0]
+        return float(np.sqrt(np.mean((X @ self.weights - y) ** 2)))
+
 
 class XNimmtAgent:
     """
@@ -27,12 +519,28 @@ class XNimmtAgent:
    -------
    AgentFunction(percepts)
       Returns the card from hand to play with.
-   expectimax(self, table, my_hand, unseen, card, depth, pruning)
-      Returns evaluation of how good a card is to play
-   evaluate(self, table, my_hand, unseen_numbers)
+   search_root(state)
+      Iterative deepening over my hand within self.time_budget, returns the card to play
+   encode_state(table, my_hand, unseen)
+      Returns the compact SearchState for a percept table, hand and unseen card numbers
+   canonical_key(state, card)
+      Returns the reduced form of a state (and card) shared by states that play out the same
+   sample_card(state)
+      Determinized sampling over opponent hands within self.time_budget, for big decks
+   expectimax(self, state, card, depth, pruning)
+      Returns evaluation of how good a card is to play (results cached in self.tt)
+   fixed_depth(depth)
+      Searches to a fixed depth on every move, for reproducible decisions and work
+   close()
+      Stops the root search worker processes started for root_workers
+   evaluate(self, state)
      Returns a n estimate in "points" how bad this position is for my agent (The greater the points the worse the position).
    """
     
+    # Attributes that change what the search computes, copied to the root workers' agents
+    SEARCH_SETTINGS = ("num_players", "opp_samples", "evaluator", "bucket_replies", "order_replies_depth",
+                       "canonical_depth", "am_pruning")
+
     def __init__(self, deck, num_rows, max_cards_in_hand, xth_card_takes):
         """
         :param deck: list of tuples (card number, card value) in the deck
@@ -42,14 +550,53 @@ class XNimmtAgent:
         """
         self.deck = deck
         self.deck_map = {n: (n, value) for (n, value) in deck} # Create a lookup-table/hashmap
+        self.points = [0] * (max(n for (n, value) in deck) + 1) # card value indexed by card number
+        for (n, value) in deck:
+            self.points[n] = value
         self.num_rows = num_rows
         self.max_cards_in_hand = max_cards_in_hand
+        self.num_players = 2 # Set by the game's Player to the real number of players
+        self.opp_samples = 32 # With more than one opponent, joint replies searched per node (all of them if there are fewer)
         self.all_numbers = set(self.deck_map.keys())
         self.xth_card_takes = xth_card_takes
-        self.max_depth = 3  # Can be changed for the program to run at different speeds. Was faster at 2 (less accurate), too slow at 4 for large tables
+        self.max_depth = max_cards_in_hand  # Deepest search tried, no point going past the cards left in hand
+        self.time_budget = 1.0 # Seconds per move for iterative deepening, None searches straight to max_depth
+        self.deadline = None # perf_counter time the current iteration has to finish by
+        self.reproducible = False # Set by the game for seeded runs: the time budget is counted in nodes instead, node_rate a second
+        self.node_rate = 100000 # Search nodes per second of time_budget when reproducible (about what one core searches)
+        self.node_limit = None # self.nodes count the current iteration has to finish by, when reproducible
+        self.depth_reached = 0 # Deepest fully searched depth on the last move
+        self.nodes = 0 # Search nodes expanded plus leaves evaluated, never reset here (for benchmarks/profiling)
+        self.prunes = 0 # Branches cut off by pruning, never reset here
+        self.instrument_hook = None # Set by the game's instrumentation during a move, takes (name, value)
+        self.tt = TranspositionTable(max_entries=200000, policy="lru") # Shared between my cards and between moves of one game
         self.removed_from_table = set() # Used to help keep track of opponent cards
         self.prev_table = None 
         self.am_pruning = True # Toggle used for testing
+        self.order_replies_depth = None # Order opponent replies by estimated cost at nodes with at least this depth left, None never
+        self.endgame_cards = 3 # With this many cards or fewer in hand play the exact endgame (endgame_card)
+        self.endgame_mode = "expect" # "expect" averages over opponent cards, "worst" assumes the worst one
+        self.endgame_memo = {} # canonical_key -> exact endgame value, cleared every game
+        self.all_cards = (1 << (max(self.all_numbers) + 1)) - 2 # bitmask of every card number
+        self.canonical_cache = {} # live cards mask -> what canonical_key needs for it, cleared every game
+        self.canonical_depth = 2 # Nodes with at least this depth left go in the tt under canonical_key, below it the key costs more than a hit saves
+        # Precomputed first moves, looked up when the hand is full and every row has one card
+        self.num_cards_in_deck = max(self.all_numbers)
+        self.use_opening_book = OpeningBook.fits(self.num_cards_in_deck)
+        self.opening_book = OpeningBook(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            OpeningBook.file_name(self.num_cards_in_deck, max_cards_in_hand, xth_card_takes, num_rows)))
+        self.search_mode = "auto" # "expectimax", "sample" (sample_card) or "auto": sample when more than sample_above_unseen cards are unseen
+        self.sample_above_unseen = 24
+        self.sample_depth = 3 # Tricks played out in every sampled rollout before evaluate
+        self.max_samples = 2000 # Sampled opponent hands per move at most (also the limit when time_budget is None)
+        self.model_opponent = False # Weight opponent replies by opponent_model (2 players only)
+        self.opponent_model = OpponentModel(xth_card_takes) # Kept across the games of a session
+        self.prev_state = None # SearchState and card of my last move, to see what the opponent played
+        self.evaluator = None # Evaluator for the search leaves (e.g. LinearEvaluator), None for the heuristic in evaluate
+        self.bucket_replies = False # Merge interchangeable opponent replies (approximate, see reply_buckets)
+        self.root_workers = 0 # Processes for searching my cards in parallel, 0 or 1 searches in this process
+        self.root_pool = None # RootSearchPool, started on the first move that uses it
+        self.shared_bound = None # Best root score shared between root workers, set inside workers only
         
       
     
@@ -58,7 +605,12 @@ class XNimmtAgent:
         
         if len(my_hand) == self.max_cards_in_hand: # Reset if needed
             self.prev_table = None 
+            self.prev_state = None
             self.removed_from_table.clear()
+            self.tt.clear()
+            self.endgame_memo.clear()
+            self.canonical_cache.clear()
+            self.opponent_model.commit() # learn from the last game between games only
 
         # Cards not yet played by either player
         if self.prev_table is not None:
@@ -66,6 +618,12 @@ class XNimmtAgent:
             curr_nums = {n for row in table for (n, value) in row}
             picked_up = prev_nums - curr_nums
             if picked_up: self.removed_from_table.update(picked_up)
+            if self.model_opponent and self.num_players == 2 and self.prev_state is not None:
+                prev_state, my_card = self.prev_state
+                # New card on the table that isn't mine, unless a take later in the trick picked it up
+                opp_cards = curr_nums - prev_nums - {my_card}
+                if len(opp_cards) == 1:
+                    self.opponent_model.observe(prev_state, opp_cards.pop())
         
         self.prev_table = [list(row) for row in table]
 	                    
@@ -76,77 +634,514 @@ class XNimmtAgent:
             seen.update(n for (n, value) in row)
         
         unseen = list(self.all_numbers - seen) # possible opp cards
+        state = self.encode_state(table, my_hand, unseen)
+
+
+        if self.instrument_hook is None:
+            card = self.search_root(state) # just the num value to play
+            self.prev_state = (state, card)
+            return card
+
+        nodes, prunes, hits, misses = self.nodes, self.prunes, self.tt.hits, self.tt.misses
+        card = self.search_root(state)
+        self.prev_state = (state, card)
+        self.instrument_hook("nodes", self.nodes - nodes)
+        self.instrument_hook("prunes", self.prunes - prunes)
+        self.instrument_hook("tt_hits", self.tt.hits - hits)
+        self.instrument_hook("tt_misses", self.tt.misses - misses)
+        self.instrument_hook("depth_reached", self.depth_reached)
+        return card
+
+    def search_root(self, state):
+        """
+        Iterative deepening: search depth 1, 2, 3... until the time budget (in nodes when
+        reproducible) runs out and play the best card from the deepest depth that finished. Each depth tries the cards in the order
+        the previous depth ranked them, so the best card sets the pruning bound first.
+        """
+        order = list(card_bits(state.hand))
+        if self.use_opening_book and self.num_players == 2 and len(order) == self.max_cards_in_hand and all(row[1] == 1 for row in state.rows):
+            card = self.opening_book.lookup(OpeningBook.key(state, self.num_cards_in_deck))
+            if card is not None and (state.hand >> card) & 1:
+                return card
+
+        if self.search_mode == "sample" or (self.search_mode == "auto" and bin(state.unseen).count("1") > self.sample_above_unseen):
+            self.depth_reached = min(self.sample_depth, len(order))
+            return self.sample_card(state)
+
+        # With sampled joint replies (see opponent_replies) the endgame isn't exact and costs
+        # opp_samples^cards, so past 2 cards it is left to the time bounded search
+        endgame_cards = self.endgame_cards
+        if self.num_players > 2 and math.comb(bin(state.unseen).count("1"), self.num_players - 1) > self.opp_samples:
+            endgame_cards = min(endgame_cards, 2)
+        if len(order) <= endgame_cards:
+            self.depth_reached = len(order)
+            return self.endgame_card(state)
+
+        max_depth = max(1, min(self.max_depth, len(order)))
+        deadline = None
+        node_limit = None
+        if self.time_budget is None:
+            depths = [max_depth]
+        else:
+            depths = range(1, max_depth + 1)
+            if self.reproducible:
+                node_limit = self.nodes + int(self.time_budget * self.node_rate)
+            else:
+                deadline = time.perf_counter() + self.time_budget
+
+        best_card = None
+        self.depth_reached = 0
+        for depth in depths:
+            if depth > 1: # depth 1 always finishes so there is a move to play
+                self.deadline = deadline
+                self.node_limit = node_limit
+            try:
+                card, scores = self.search_depth(state, order, depth)
+            except SearchTimeout:
+                break
+            finally:
+                self.deadline = None
+                self.node_limit = None
+            best_card = card
+            self.depth_reached = depth
+            order.sort(key=lambda c: (scores[c], c))
+
+        return best_card
+
+    def endgame_card(self, state):
+        """
+        Exact endgame: with few cards left search every trick to the end of the game, without the
+        heuristic evaluate. Values are memoized by state in self.endgame_memo (the same positions
+        come back through different orders of play and on the next moves).
+        :return: the card with the lowest exact expected penalty (lowest card number on a tie)
+        """
+        best_card = None
+        best_value = float("inf")
+        for card in card_bits(state.hand):
+            value = self.endgame_card_value(state, card)
+            if value < best_value:
+                best_value = value
+                best_card = card
+        return best_card
 
+    def endgame_value(self, state):
+        """
+        Penalty (positive) still to come from this state with best play, for the opponent playing
+        any unseen card with equal chance ("expect") or the worst one for me ("worst"). With more
+        than one opponent the replies are those of opponent_replies, so only exact while there
+        are no more than opp_samples of them.
+        """
+        key = self.canonical_key(state)[0]
+        value = self.endgame_memo.get(key)
+        if value is None:
+            if not state.hand:
+                value = 0.0
+            else:
+                value = min(self.endgame_card_value(state, card) for card in card_bits(state.hand))
+            self.endgame_memo[key] = value
+        return value
+
+    def endgame_card_value(self, state, my_card):
+        rows, my_hand, unseen = state
+        self.nodes += 1
+        my_next_hand = my_hand & ~(1 << my_card)
+        if not unseen: # nothing left the opponent could have, my card goes down alone
+            t, my_pts, _ = rows_resolve(rows, my_card, self.points, self.xth_card_takes)
+            return -my_pts + self.endgame_value(SearchState(t, my_next_hand, 0))
+
+        buckets, num_choices = self.opponent_replies(rows, unseen, my_hand)
+        values = [(-my_pts + self.endgame_value(next_state), count)
+                  for my_pts, opp_card, count, next_state
+                  in self.resolve_replies(rows, my_card, my_next_hand, unseen, buckets)]
+        if self.endgame_mode == "worst":
+            return max(value for value, count in values)
+        return sum(value * count for value, count in values) / num_choices
+
+    def sample_card(self, state):
+        """
+        Determinized sampling instead of expectimax, so the cost grows with the number of samples
+        rather than with the unseen cards (expectimax is about |unseen|^depth). Every sample deals
+        the opponent a random hand from unseen and a random order to play it in, then every card
+        of mine is played out against that same sample for sample_depth tricks (my later cards
+        picked by their immediate penalty, without looking at the opponent's) and scored with
+        evaluate at the end. Samples are drawn until the time budget or max_samples runs out.
+        :return: the card with the lowest average penalty over the samples (lowest card number on a tie)
+        """
+        rows, my_hand, unseen = state
+        cards = list(card_bits(my_hand))
+        if len(cards) == 1:
+            return cards[0]
+        unseen_cards = list(card_bits(unseen))
+        num_opponents = self.num_players - 1
+        opp_size = min(len(cards) * num_opponents, len(unseen_cards))
+        depth = max(1, min(self.sample_depth, len(cards), opp_size // num_opponents))
+
+        deadline = None
+        node_limit = None
+        if self.time_budget is not None:
+            if self.reproducible:
+                node_limit = self.nodes + int(self.time_budget * self.node_rate)
+            else:
+                deadline = time.perf_counter() + self.time_budget
+        totals = dict.fromkeys(cards, 0.0)
+        samples = 0
+        while samples < self.max_samples:
+            if samples and deadline is not None and time.perf_counter() > deadline:
+                break
+            if samples and node_limit is not None and self.nodes > node_limit:
+                break
+            opp_cards = random.sample(unseen_cards, opp_size)
+            if num_opponents == 1:
+                opp_plays = opp_cards[:depth]
+            else:
+                opp_plays = [tuple(opp_cards[t*num_opponents:(t+1)*num_opponents]) for t in range(depth)]
+            for card in cards:
+                totals[card] += self.rollout(state, card, opp_plays)
+            samples += 1
 
+        return min(cards, key=lambda card: (totals[card], card))
+
+    def rollout(self, state, my_card, opp_plays):
+        """
+        Plays my_card and then my cheapest looking cards against the opponents' sampled cards
+        (one card per trick, or a tuple of them with more than one opponent), returns the points
+        taken plus evaluate of where it ends up (positive, lower is better)
+        """
+        rows, my_hand, unseen = state
+        penalty = 0
+        for k, opp_card in enumerate(opp_plays):
+            if k:
+                my_card = min(card_bits(my_hand), key=lambda card: -rows_resolve(rows, card, self.points, self.xth_card_takes)[1])
+            self.nodes += 1
+            my_hand &= ~(1 << my_card)
+            my_pts, _, _, next_state = next(self.resolve_replies(rows, my_card, my_hand, unseen, ((opp_card, 1),)))
+            penalty -= my_pts
+            rows, unseen = next_state.rows, next_state.unseen
+            if not my_hand:
+                break
+        return penalty + self.evaluate(SearchState(rows, my_hand, unseen))
+
+    def search_depth(self, state, order, depth):
+        """
+        One fixed depth search over my cards in the given order.
+        :return: (best card, dict of card -> score) where pruned cards score a lower bound
+        """
         best_score = float("inf") # Want a score as close to 0 as possible
         best_card = None # updated as go through my hand with it being changed if the score for that card is lower then 'best_score
+        scores = {}
 
-        for card in my_hand:
-            pruning = best_score if self.am_pruning else float("inf") # toggle for pruning
-            score = self.expectimax(table, my_hand, unseen, card, self.max_depth, pruning = pruning) 
-            if score < best_score or (score == best_score and card[0] < best_card[0]): # Picks the card with lowest penalty
+        pool = self.get_root_pool() if len(order) > 2 else None
+        results = {}
+        for i, card in enumerate(order):
+            if pool is not None and i == 1:
+                # The first (best ranked) card was searched here to set the bound, the rest go to the workers
+                budget = None
+                if self.deadline is not None:
+                    budget = self.deadline - time.perf_counter()
+                results = pool.search(state, order[1:], depth, budget, best_score if self.am_pruning else None)
+                if results is None:
+                    raise SearchTimeout()
+            if card in results:
+                score, exact = results[card]
+            else:
+                pruning = best_score if self.am_pruning else float("inf") # toggle for pruning
+                score, exact = self._expectimax(state, card, depth, pruning = pruning) 
+            if not exact and score < best_score:
+                # Pruning deeper down only gave a lower bound, that says nothing about beating
+                # best_score so get the real value (mostly from the transposition table)
+                score, exact = self._expectimax(state, card, depth, pruning = float("inf"))
+            scores[card] = score
+            if score < best_score or (score == best_score and exact and card < best_card): # Picks the card with lowest penalty
                 best_score = score # the above ^ or () condition is if the best_score is even then take the one with card number
                 best_card = card
 
-        return best_card[0] # just the num value to play
+        return best_card, scores
 
-    def expectimax(self, table, my_hand, unseen, my_card, depth, pruning):
+    def get_root_pool(self):
+        """
+        Returns the RootSearchPool if root_workers asks for one and this process can start it, else None.
+        Reproducible searches stay in this process, the workers' nodes depend on when they see each other's bounds.
+        The workers get the current SEARCH_SETTINGS, a pool started with other ones (or another
+        evaluator object) is replaced. An evaluator changed in place (e.g. refit) needs a new pool.
+        """
+        if self.root_workers <= 1 or self.model_opponent or self.reproducible or not RootSearchPool.available():
+            return None
+        agent_settings = {name: getattr(self, name) for name in self.SEARCH_SETTINGS}
+        if (self.root_pool is None or len(self.root_pool.workers) != self.root_workers
+                or self.root_pool.agent_settings != agent_settings):
+            if self.root_pool is not None:
+                self.root_pool.close()
+            agent_args = (self.deck, self.num_rows, self.max_cards_in_hand, self.xth_card_takes)
+            self.root_pool = RootSearchPool(agent_args, self.root_workers, agent_settings)
+        return self.root_pool
+
+    def fixed_depth(self, depth):
+        """
+        Searches every move with expectimax to depth, without a time budget, the opening book or
+        sampling, and the exact endgame only once the cards left are within depth, so the same
+        percepts always give the same card and the same work (replays, benchmarks, self-play)
+        """
+        self.time_budget = None
+        self.max_depth = depth
+        self.use_opening_book = False
+        self.search_mode = "expectimax"
+        self.endgame_cards = min(self.endgame_cards, depth)
+
+    def close(self):
+        """
+        Stops the root search workers, if any (they are also stopped when the agent is garbage collected)
+        """
+        if self.root_pool is not None:
+            self.root_pool.close()
+            self.root_pool = None
+
+    def encode_state(self, table, my_hand, unseen):
+        """
+        Packs the percept table, my hand and the unseen card numbers into a SearchState
+        """
+        rows = tuple((row[-1][0], len(row), sum(value for (n, value) in row)) for row in table)
+        hand = 0
+        for (n, value) in my_hand:
+            hand |= 1 << n
+        unseen_mask = 0
+        for n in unseen:
+            unseen_mask |= 1 << n
+        return SearchState(rows, hand, unseen_mask)
+
+    def canonical_key(self, state, card=None):
+        """
+        Reduced form of a state for the transposition table and the endgame memo, the same for
+        states that play out the same. Only the order of the live cards (my hand, unseen and row
+        tops) matters to the rules, evaluate, the opponent model and the sampled replies of
+        opponent_replies (seeded by this key), so the cards that are gone (played and covered,
+        or taken) are squeezed out of the card numbers and the points of the live cards kept
+        alongside. An evaluator that isn't order_only can tell such states apart, the search
+        doesn't use this key for the transposition table with it.
+        Rows keep their places: a forced take picks the first of the rows with the least points,
+        so the same rows in another order don't always play out the same.
+        :param card: a live card number to renumber with the state (e.g. the card I play)
+        :return: ((rows, hand, unseen, points of the live cards), card renumbered)
+        """
+        rows, hand, unseen = state
+        live = hand | unseen
+        for row in rows:
+            live |= 1 << row[0]
+        entry = self.canonical_cache.get(live)
+        if entry is None:
+            # The gone cards highest first (so squeezing one out doesn't move the lower ones)
+            gone = self.all_cards & ~live
+            entry = (gone, list(card_bits(gone))[::-1], tuple(self.points[n] for n in card_bits(live)))
+            self.canonical_cache[live] = entry
+        gone, gaps, values = entry
+        for n in gaps:
+            low = (1 << n) - 1
+            hand = (hand & low) | ((hand >> 1) & ~low)
+            unseen = (unseen & low) | ((unseen >> 1) & ~low)
+        rows_key = tuple((top - bin(gone & ((1 << top) - 1)).count("1"), length, row_points)
+                         for top, length, row_points in rows)
+        card_key = None if card is None else card - bin(gone & ((1 << card) - 1)).count("1")
+        return (rows_key, hand, unseen, values), card_key
+
+    def expectimax(self, state, my_card, depth, pruning):
         """
         Simultaneous move expectimax:
         - Fix my_card for this round.
         - Average over all possible opponent cards from unseen.
         - Resolve the round and recurse.
         """
+        return self._expectimax(state, my_card, depth, pruning)[0]
+
+    def _expectimax(self, state, my_card, depth, pruning, root=False):
+        """
+        expectimax that also says whether the value is exact (False means it is only a
+        lower bound, at least pruning, because this branch or one below it was pruned).
+        pruning is the bound for this node: a value at or above it is not needed exactly. Every
+        continuation below gets the bound it has to stay under for this node's average to stay
+        under pruning (with the replies still to come counted as 0, the least they can add).
+        :param root: the card is one of a root worker's, its bound follows shared_bound (read
+                     again at every reply)
+        """
         if depth == 0: # Base Case
-            return self.evaluate(table, my_hand, unseen)
+            return self.evaluate(state), True
+
+        self.nodes += 1
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise SearchTimeout()
+        if self.node_limit is not None and self.nodes > self.node_limit:
+            raise SearchTimeout()
+
+        if root and self.shared_bound is not None and self.shared_bound.value < pruning:
+            pruning = self.shared_bound.value # another root worker found a better card
+
+        if depth >= self.canonical_depth and (self.evaluator is None or self.evaluator.order_only):
+            state_key, card_key = self.canonical_key(state, my_card)
+            key = (state_key, card_key, depth)
+        else:
+            key = (state, my_card, depth)
+        cached = self.tt.lookup(key, pruning)
+        if cached is not None:
+            return cached
 
         total_score = 0 # keep track of the branches score
-        opp_choices = unseen
-        
+        exact = True
+        rows, my_hand, unseen = state
+        # Remove the card we just played from our recurs params, a single bit flip
+        my_next_hand = my_hand & ~(1 << my_card)
 
-        for opp_num in opp_choices:
-            opp_card = self.deck_map[opp_num] # opp_choices is just a list of unseen so with deck_map I can just make map O(1)
+        if self.bucket_replies and self.num_players == 2 and not self.model_opponent:
+            buckets = self.reply_buckets(rows, my_hand, unseen)
+            num_choices = bin(unseen).count("1")
+        else:
+            buckets, num_choices = self.opponent_replies(rows, unseen, my_hand)
 
-            # Resolve round in ascending card order (Remember that the lowest card is placed first)
-            t = copy.deepcopy(table) #deep copy the table as we recurse updating this new deepcopy
-            if my_card[0] < opp_card[0]: # the lower card is played first  
-                t, my_pts, _ = table_resolve(t, my_card, self.xth_card_takes)
-                t, _, _ = table_resolve(t, opp_card, self.xth_card_takes)
-            else: # opp card lower they play first
-                t, _, _ = table_resolve(t, opp_card, self.xth_card_takes)
-                t, my_pts, _ = table_resolve(t, my_card, self.xth_card_takes)
+        leaf = depth - 1 == 0 or not my_next_hand
+        # Ordering costs an evaluate per reply, only worth it above big enough subtrees
+        order = self.order_replies_depth is not None and depth >= self.order_replies_depth and not leaf
+        replies = self.resolve_replies(rows, my_card, my_next_hand, unseen, buckets)
+        if order:
+            # Most expensive replies first (by the heuristic) so the pruning bound is reached sooner
+            replies = sorted(replies, key=lambda reply: reply[0] - self.evaluate(reply[3]))
+
+        leaf_values = None
+        if leaf and self.evaluator is not None:
+            # All the leaves below this node in one batch
+            replies = list(replies)
+            leaf_values = self.evaluator.evaluate_batch(self, [reply[3] for reply in replies])
+            self.nodes += len(replies)
+
+        for i, (my_pts, opp_card, count, next_state) in enumerate(replies):
 
-            # Update hands and unseen cards for recursion (Remove the card we just played from our recurs params)
-            my_next_hand = [c for c in my_hand if c[0] != my_card[0]] 
-            next_unseen = [u for u in unseen if u not in (my_card[0], opp_card[0])]
+            if root and self.shared_bound is not None and self.shared_bound.value < pruning:
+                pruning = self.shared_bound.value # another root worker found a better card meanwhile
 
-            if depth - 1 == 0 or not my_next_hand : # If played last card or depth-limit then we evaluate with curr table
-                score = -my_pts + self.evaluate(t, my_next_hand, next_unseen) 
+            if leaf : # If played last card or depth-limit then we evaluate with curr table
+                score = -my_pts + (self.evaluate(next_state) if leaf_values is None else leaf_values[i])
             else:
+                # The continuation that takes this reply's share of the average up to pruning
+                reply_bound = (pruning * num_choices - total_score) / count + my_pts
                 best_next_round_cost = float("inf")
-                for next_card in my_next_hand:
-                    next_round_cost = self.expectimax(t, my_next_hand, next_unseen, next_card, depth - 1, pruning=pruning)
+                best_is_exact = True
+                lowest_bound = float("inf") # smallest continuation that was only a lower bound
+                if reply_bound <= 0:
+                    # Any continuation gets there, none is below 0
+                    best_next_round_cost = 0.0
+                    best_is_exact = False
+                for next_card in card_bits(my_next_hand if reply_bound > 0 else 0):
+                    # Only needed exactly below the cheapest continuation so far and below reply_bound
+                    next_bound = min(reply_bound, best_next_round_cost) if self.am_pruning else float("inf")
+                    next_round_cost, next_exact = self._expectimax(next_state, next_card, depth - 1, pruning=next_bound)
+                    if not next_exact and next_round_cost < lowest_bound:
+                        lowest_bound = next_round_cost
                     # Keep cheapest continuation
                     if next_round_cost < best_next_round_cost:
                         best_next_round_cost = next_round_cost
+                        best_is_exact = next_exact
                         if best_next_round_cost == 0.0: # Cannot beat '0.0' lets early exit no need to continue looping
                             break
+                # the min is exact only if no pruned continuation could have been cheaper
+                if not best_is_exact or lowest_bound < best_next_round_cost:
+                    exact = False
                 # Total cost for this opponent reply is my peantly this round + best continuation
                 score = -my_pts + best_next_round_cost
-            # add on to running sum over all opponent replies
-            total_score += score
+            # add on to running sum over all opponent replies, once for every card in the bucket
+            total_score += score * count
             
             # prune the lower bound on final average
             # each per-reply is => 0, so even if all reaminging were 0
             # the final avg can't be lower then (total-score /total_number_of_replies)
-            prune = total_score /len(opp_choices)
+            prune = total_score / num_choices
             if prune >= pruning:
-                # this card can't beat the best card we've already found at the root so prune
-                return prune
+                # the value is at least the bound, the caller doesn't need it exactly (at the root:
+                # this card can't beat the best card we've already found) so prune
+                self.prunes += 1
+                self.tt.store(key, prune, TranspositionTable.LOWER)
+                return prune, False
         # considered all opponent replies return the average expected cost
-        return total_score / len(opp_choices) 
+        value = total_score / num_choices
+        self.tt.store(key, value, TranspositionTable.EXACT if exact else TranspositionTable.LOWER)
+        return value, exact
 
-    def evaluate(self, table, my_hand, unseen_numbers):
+    def opponent_replies(self, rows, unseen, hand):
+        """
+        Replies the opponents can make this trick, as (buckets, total count) for resolve_replies.
+        With one opponent every unseen card once, or weighted by the opponent model. With more, enumerating every joint reply grows
+        exponentially with the players, so the opponents' combined play is modelled by a sample of
+        opp_samples sets of num_players - 1 distinct unseen cards (every set if there are no
+        more than that). The sample is seeded by the position (its canonical_key, so states that
+        share a key get the same replies), so all my cards are compared on the same replies and
+        the search stays repeatable.
+        """
+        num_opponents = self.num_players - 1
+        if num_opponents == 1:
+            if self.model_opponent:
+                return self.opponent_model.reply_weights(rows, hand, unseen)
+            return ((opp_card, 1) for opp_card in card_bits(unseen)), bin(unseen).count("1")
+
+        unseen_cards = list(card_bits(unseen))
+        if len(unseen_cards) <= num_opponents:
+            return [(tuple(unseen_cards), 1)], 1
+        if math.comb(len(unseen_cards), num_opponents) <= self.opp_samples:
+            replies = [(cards, 1) for cards in itertools.combinations(unseen_cards, num_opponents)]
+            return replies, len(replies)
+        rnd = random.Random(hash(self.canonical_key(SearchState(rows, hand, unseen))[0]))
+        replies = [(tuple(sorted(rnd.sample(unseen_cards, num_opponents))), 1) for _ in range(self.opp_samples)]
+        return replies, self.opp_samples
+
+    def resolve_replies(self, rows, my_card, my_next_hand, unseen, buckets):
+        """
+        Yields (my points, opp card, bucket count, next state) for every opponent reply bucket
+        (opp card is a sorted tuple of cards, one per opponent, with more than one opponent)
+        """
+        if self.num_players > 2:
+            for opp_cards, count in buckets:
+                # The whole trick goes down in ascending order
+                trick = sorted(opp_cards + (my_card,))
+                t, taken = rows_resolve_trick(rows, trick, self.points, self.xth_card_takes)
+                next_unseen = unseen
+                for opp_card in opp_cards:
+                    next_unseen &= ~(1 << opp_card)
+                yield taken[trick.index(my_card)], opp_cards, count, SearchState(t, my_next_hand, next_unseen)
+            return
+
+        for opp_card, count in buckets:
+            # Resolve round in ascending card order (Remember that the lowest card is placed first)
+            if my_card < opp_card: # the lower card is played first  
+                t, my_pts, _ = rows_resolve(rows, my_card, self.points, self.xth_card_takes)
+                t, _, _ = rows_resolve(t, opp_card, self.points, self.xth_card_takes)
+            else: # opp card lower they play first
+                t, _, _ = rows_resolve(rows, opp_card, self.points, self.xth_card_takes)
+                t, my_pts, _ = rows_resolve(t, my_card, self.points, self.xth_card_takes)
+            yield my_pts, opp_card, count, SearchState(t, my_next_hand, unseen & ~(1 << opp_card))
+
+    def reply_buckets(self, rows, hand, unseen):
+        """
+        Groups the unseen cards into buckets of opponent replies that play out the same this round.
+        Unseen cards next to each other (no card of mine or row top in between) with the same
+        points land on the same row with the same penalties, so one of them is resolved and
+        weighted by the bucket size. This is an approximation: the card that stays on the table
+        differs between them, which changes later forced takes, so it is only used when
+        bucket_replies is on (cuts the branching a lot on big decks where most cards are worth 1).
+        :return: list of (lowest card of the bucket, number of cards in the bucket)
+        """
+        live = hand | unseen
+        for row in rows:
+            live |= 1 << row[0]
+
+        buckets = []
+        run_card = None
+        run_points = None
+        for n in card_bits(live):
+            if not (unseen >> n) & 1:
+                run_card = None # one of my cards or a row top splits the run
+            elif run_card is not None and self.points[n] == run_points:
+                buckets[-1][1] += 1
+            else:
+                run_card = n
+                run_points = self.points[n]
+                buckets.append([n, 1])
+        return buckets
+
+    def evaluate(self, state):
         
         """
         Heuristic evaluation of the position is done with the engine points and possible outcome for opponent hand
@@ -154,34 +1149,55 @@ class XNimmtAgent:
         Higher the state the worse it is
         Combination of two point taking actions
         1. The smallest immediate penalty we would take for a card in my hand. Because I use a positive prune 
-           The table_resolve is -table_resolve so that it returns a positive
+           the penalty is returned as a positive number (see hand_penalty)
         2. The probablity that a random "unseen" card is smaller than all row tops (can't be placed) * the points in 
            the least cost row. Which the engine chooses ona. forced take). this captures table "pressure independent of our hand.
            
            Then return LB + FT. the return is non negative so can be pruned by total_score / len(opp_choices) 
         """
+        self.nodes += 1
+        if self.evaluator is not None:
+            return self.evaluator.evaluate(self, state)
+        rows, my_hand, unseen = state
+        if not rows:
+            return 0.0
+        # on a forced take you take the lowest val row
+        least_row_points = min(row[2] for row in rows)
 
         lower_bound = 0.0
         if my_hand: # If I  still have cards in my hand compute cheapest cost
-            lower_bound = min(
-                (-table_resolve(table, card, self.xth_card_takes)[1]) # -table-resolve because makes it positive number
-                for card in my_hand
-            )
+            lower_bound = self.hand_penalty(rows, my_hand, least_row_points)
 
         forced_expect = 0.0
-        if table and unseen_numbers:
-            tops = [row[-1][0] for row in table if row] #last num of list is '-1' so can get it easily
-            if tops:
-                min_top = min(tops)  # must be smaller than ALL tops to force a take
-                forced_count = sum(1 for n in unseen_numbers if n < min_top)
-                total_unseen = len(unseen_numbers)
-                p_forced = forced_count / total_unseen if total_unseen > 0 else 0.0
-                # on a forced take you take the lowest val row
-                least_row_points = min(sum(c[1] for c in row) for row in table)
-                forced_expect = p_forced * least_row_points
+        if unseen:
+            min_top = min(row[0] for row in rows)  # must be smaller than ALL tops to force a take
+            # unseen cards below min_top are exactly the bits below it in the mask
+            forced_count = bin(unseen & ((1 << min_top) - 1)).count("1")
+            p_forced = forced_count / bin(unseen).count("1")
+            forced_expect = p_forced * least_row_points
         
-        return lower_bound + forced_expect    
-            
-      
+        return lower_bound + forced_expect
 
-    
+    def hand_penalty(self, rows, hand, least_row_points):
+        """
+        Smallest immediate penalty (as a positive number) over the cards in hand, for all cards in
+        one sweep: the hand comes out of the bitmask in ascending order, so walking up the rows
+        sorted by top finds the row each card lands on without resolving the table per card.
+        """
+        by_top = sorted(rows) # rows sort on their top card
+        last = len(by_top) - 1
+        below = -1 # index in by_top of the highest top below the card
+        best = None
+        for card in card_bits(hand):
+            while below < last and by_top[below + 1][0] < card:
+                below += 1
+            if below < 0:
+                penalty = least_row_points # can't be placed, forced take
+            else:
+                top, length, row_points = by_top[below]
+                penalty = row_points if length >= self.xth_card_takes else 0
+            if penalty == 0:
+                return 0 # Cannot beat 0
+            if best is None or penalty < best:
+                best = penalty
+        return best
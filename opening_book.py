@@ -0,0 +1,145 @@
+__author__ = "Cam Clark"
+__organization__ = "COSC343/AIML402, University of Otago"
+__email__ = "claca067@student.otago.ac.nz"
+
+# Offline generator for my_agent's opening book. For the deck configuration in settings.py it
+# searches opening positions (full hand, one card in every row) deeper than the agent can
+# afford during a game and writes the chosen cards next to my_agent.py, e.g.
+#
+#    python opening_book.py --positions 2000 --depth 5 --workers 4
+#    python opening_book.py --all --depth 3
+#
+# Positions already in the book are kept and not searched again, so the book can be grown a
+# batch at a time. The agent memory-maps the file on its first move and looks the opening up
+# before searching.
+
+import argparse
+import itertools
+import multiprocessing
+import os
+import time
+import numpy as np
+from settings import game_settings
+from xnimmt import XNimmtGame, time_to_str
+from my_agent import XNimmtAgent, OpeningBook, SearchState
+
+
+def sampled_positions(game, num_positions, seed):
+   """Opening positions (hand, row tops) of seeded deals, every player's hand of a deal is one"""
+   H = game.max_cards_in_hand
+   num_deals = -(-num_positions // game.num_players)
+   all_decks, _ = game.deal_decks(num_deals, seed)
+   positions = []
+   for deck in all_decks:
+      cards = [game.deck[i][0] for i in deck]
+      tops = tuple(sorted(cards[game.num_players*H:game.num_players*H + game.num_rows]))
+      for p in range(game.num_players):
+         positions.append((tuple(sorted(cards[p*H:(p+1)*H])), tops))
+   return positions[:num_positions]
+
+
+def all_positions(game):
+   """Every opening position of the deck, only practical for small decks"""
+   numbers = [n for (n, value) in game.deck]
+   for hand in itertools.combinations(numbers, game.max_cards_in_hand):
+      rest = [n for n in numbers if n not in hand]
+      for tops in itertools.combinations(rest, game.num_rows):
+         yield hand, tops
+
+
+def _init_book_worker(game, depth):
+   global _worker_agent
+   _worker_agent = XNimmtAgent(deck=list(game.deck), num_rows=game.num_rows,
+                               max_cards_in_hand=game.max_cards_in_hand, xth_card_takes=game.xth_card_takes)
+   _worker_agent.fixed_depth(depth)
+
+def _search_position(position):
+   hand, tops = position
+   points = _worker_agent.points
+   percepts = ([(n, points[n]) for n in hand], [[(n, points[n])] for n in tops])
+   return _worker_agent.AgentFunction(percepts)
+
+
+def load_book(path):
+   if not os.path.exists(path):
+      return np.zeros(0, dtype=OpeningBook.DTYPE)
+   return np.load(path)
+
+def save_book(path, entries):
+   """Writes the entries sorted by key, through a temporary file so a reader never sees half a book"""
+   entries = np.sort(entries, order="key")
+   tmp_path = path + ".tmp.npy"
+   np.save(tmp_path, entries)
+   os.replace(tmp_path, path)
+
+
+def generate(game, positions, depth, num_workers=1, path=None):
+   """Searches the positions not yet in the book at path and adds them to it
+
+   :return: (path, number of positions added, number of entries in the book)
+   """
+   num_cards_in_deck = game.num_cards_in_deck
+   if game.num_players != 2:
+      raise RuntimeError("Error! The opening book is only used in 2-player games")
+   if not OpeningBook.fits(num_cards_in_deck):
+      raise RuntimeError(f"Error! Opening book keys only fit decks of up to 31 cards, not {num_cards_in_deck}")
+
+   if path is None:
+      path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          OpeningBook.file_name(num_cards_in_deck, game.max_cards_in_hand,
+                                                game.xth_card_takes, game.num_rows))
+   book = load_book(path)
+   known = set(int(key) for key in book["key"])
+
+   todo = {}
+   for hand, tops in positions:
+      hand_mask = 0
+      for n in hand:
+         hand_mask |= 1 << n
+      key = OpeningBook.key(SearchState(tuple((n, 1, 0) for n in tops), hand_mask, 0), num_cards_in_deck)
+      if key not in known:
+         todo[key] = (hand, tops)
+
+   keys = list(todo)
+   tasks = [todo[key] for key in keys]
+   if num_workers > 1:
+      with multiprocessing.Pool(num_workers, initializer=_init_book_worker, initargs=(game, depth)) as pool:
+         cards = pool.map(_search_position, tasks, chunksize=max(1, len(tasks) // (num_workers * 16)))
+   else:
+      _init_book_worker(game, depth)
+      cards = [_search_position(task) for task in tasks]
+
+   added = np.zeros(len(keys), dtype=OpeningBook.DTYPE)
+   added["key"] = keys
+   added["card"] = cards
+   entries = np.concatenate([book, added])
+   save_book(path, entries)
+   return path, len(added), len(entries)
+
+
+if __name__ == "__main__":
+
+   parser = argparse.ArgumentParser(description="Precompute my_agent's first move for opening positions")
+   parser.add_argument("--positions", type=int, default=1000, help="number of sampled opening positions")
+   parser.add_argument("--all", action="store_true", help="every opening position instead of a sample")
+   parser.add_argument("--depth", type=int, default=game_settings['maxCardsInHand'], help="search depth")
+   parser.add_argument("--workers", type=int, default=1, help="number of processes to search on")
+   parser.add_argument("--seed", type=int, default=game_settings['seed'], help="seed for the sampled deals")
+   parser.add_argument("--output", help="book file, by default the one my_agent.py looks for")
+   args = parser.parse_args()
+
+   game = XNimmtGame(num_players=len(game_settings['players']),
+                     num_rows=game_settings['numRows'],
+                     num_cards_in_deck=game_settings['numCardsInDeck'],
+                     max_cards_in_hand=game_settings['maxCardsInHand'],
+                     xth_card_takes=game_settings['XthCardTakes'],
+                     verbose=0)
+
+   if args.all:
+      positions = all_positions(game)
+   else:
+      positions = sampled_positions(game, args.positions, args.seed)
+
+   start = time.time()
+   path, num_added, num_entries = generate(game, positions, args.depth, num_workers=args.workers, path=args.output)
+   print("Added %d positions to %s (%d in the book) in %s" % (num_added, path, num_entries, time_to_str(time.time() - start)))
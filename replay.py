@@ -0,0 +1,179 @@
+__author__ = "Cam Clark"
+__organization__ = "COSC343/AIML402, University of Otago"
+__email__ = "claca067@student.otago.ac.nz"
+
+# Records every percept and decision of seeded games to a replay file, then plays the recorded
+# percepts to another version of an agent and reports where it decides differently and how its
+# time per move compares, e.g. before and after a speed-up of my_agent.py:
+#
+#    python replay.py record --games 200 --output before.jsonl
+#    ... change my_agent.py ...
+#    python replay.py check before.jsonl
+#    python replay.py check before.jsonl --agent my_agent_old.py --seat 0
+#
+# Agents with a fixed_depth method are run at a fixed search depth (--depth) so their decisions don't
+# depend on how fast the machine is. Each game's agent is started at the game's random seed,
+# as XNimmtGame.play_seeded does. Every seat's calls are replayed in the order they were made,
+# so the agent being checked sees the same percepts in the same order as it did in the game
+# (its memory between moves is rebuilt the same way) and draws the same random numbers.
+
+import argparse
+import json
+import random
+import sys
+import time
+import numpy as np
+from settings import game_settings
+from xnimmt import XNimmtGame, Player, time_to_str
+from instrumentation import Instrumentation
+
+
+class ReplayRecorder(Instrumentation):
+   """Instrumentation that writes every AgentFunction call (percepts, action and time) as a
+   line of the replay file"""
+
+   def __init__(self, file):
+      super().__init__(keep_moves=False)
+      self.file = file
+      self.game_seed = None
+
+   def record_move(self, p, player, percepts, action, elapsed, counters):
+      hand, table = percepts
+      self.file.write(json.dumps({"game": self.game_index, "seed": int(self.game_seed), "player": p,
+                                  "hand": [list(card) for card in hand],
+                                  "table": [[list(card) for card in row] for row in table],
+                                  "action": int(action), "time": elapsed}) + "\n")
+
+
+def fix_depth(players, depth):
+   for player in players:
+      if hasattr(player.agent, 'fixed_depth'):
+         player.agent.fixed_depth(depth)
+
+
+def record(path, settings, agentFiles, num_games, seed, depth):
+   """Plays num_games seeded games (the same ones XNimmtGame.run plays for seed) and writes the replay file"""
+   game = XNimmtGame(verbose=0, **settings)
+   players = [Player(game=game, playerFile=agentFile) for agentFile in agentFiles]
+   fix_depth(players, depth)
+
+   all_decks, game_seeds = game.deal_decks(num_games, seed)
+   with open(path, "w") as f:
+      f.write(json.dumps({"header": {"settings": settings, "agents": list(agentFiles), "games": num_games,
+                                     "seed": seed, "depth": depth}}) + "\n")
+      recorder = ReplayRecorder(f)
+      game.instrument = recorder
+      for n in range(num_games):
+         recorder.game_seed = game_seeds[n]
+         game.play_seeded(players, all_decks[n].tolist(), game_seeds[n])
+
+
+def read_replay(path):
+   with open(path) as f:
+      header = json.loads(f.readline())["header"]
+      moves = [json.loads(line) for line in f]
+   return header, moves
+
+
+def check(path, agentFile=None, seat=0):
+   """Gives the recorded percepts of one seat to agentFile (by default the agent that played it)
+
+   Every seat's recorded calls are replayed in the order they were made, the other seats with
+   the recorded agents, so agents that draw from the global random generators get the same
+   numbers as in the recorded games. Only the seat's decisions are compared.
+
+   :return: dict with the number of moves, the differing decisions and the time per move before and after
+   """
+   header, moves = read_replay(path)
+   agentFiles = list(header["agents"])
+   if agentFile is None:
+      agentFile = agentFiles[seat]
+   agentFiles[seat] = agentFile
+   game = XNimmtGame(verbose=0, **header["settings"])
+   players = [Player(game=game, playerFile=playerFile) for playerFile in agentFiles]
+   fix_depth(players, header["depth"])
+
+   immutable = header["settings"].get("immutable_percepts", False)
+   differences = []
+   old_times = []
+   new_times = []
+   current_game = None
+   for move in moves:
+      if move["game"] != current_game:
+         current_game = move["game"]
+         random.seed(move["seed"])
+         np.random.seed(move["seed"])
+      hand = [tuple(card) for card in move["hand"]]
+      table = [[tuple(card) for card in row] for row in move["table"]]
+      if immutable:
+         percepts = (tuple(hand), tuple(tuple(row) for row in table))
+      else:
+         percepts = (hand, table)
+
+      start = time.perf_counter()
+      action = players[move["player"]].agent.AgentFunction(percepts)
+      elapsed = time.perf_counter() - start
+      if move["player"] != seat:
+         continue
+
+      old_times.append(move["time"])
+      new_times.append(elapsed)
+      if action != move["action"]:
+         differences.append({"game": move["game"], "hand_size": len(hand), "hand": move["hand"],
+                             "table": move["table"], "recorded": move["action"], "replayed": int(action)})
+
+   num_moves = len(new_times)
+   old_times = np.array(old_times) if old_times else np.zeros(1)
+   new_times = np.array(new_times) if new_times else np.zeros(1)
+   ratio = new_times / np.maximum(old_times, 1e-9)
+   return {"replay": path, "agent": agentFile, "seat": seat, "moves": num_moves,
+           "differences": differences,
+           "time_recorded_s": float(old_times.sum()), "time_replayed_s": float(new_times.sum()),
+           "mean_ms": [float(old_times.mean() * 1000), float(new_times.mean() * 1000)],
+           "p99_ms": [float(np.percentile(old_times, 99) * 1000), float(np.percentile(new_times, 99) * 1000)],
+           "median_time_ratio": float(np.median(ratio))}
+
+
+if __name__ == "__main__":
+
+   parser = argparse.ArgumentParser(description="Record and replay agent decisions to check changes keep them the same")
+   commands = parser.add_subparsers(dest="command", required=True)
+
+   parser_record = commands.add_parser("record", help="play seeded games and record every decision")
+   parser_record.add_argument("--agents", nargs="+", default=list(game_settings['players']), help="agent files, one per player")
+   parser_record.add_argument("--games", type=int, default=game_settings['totalNumberOfGames'], help="number of games")
+   parser_record.add_argument("--seed", type=int, default=game_settings['seed'], help="seed of the games")
+   parser_record.add_argument("--depth", type=int, default=3, help="fixed search depth for agents with a time budget")
+   parser_record.add_argument("--output", default="replay.jsonl", help="replay file to write")
+
+   parser_check = commands.add_parser("check", help="replay recorded percepts to an agent and compare")
+   parser_check.add_argument("replay", help="replay file written by record")
+   parser_check.add_argument("--agent", help="agent file to replay to, by default the recorded one (as it is now)")
+   parser_check.add_argument("--seat", type=int, default=0, help="player whose moves are replayed")
+   parser_check.add_argument("--output", help="write the report as JSON to this file")
+   args = parser.parse_args()
+
+   if args.command == "record":
+      settings = dict(num_players=len(args.agents),
+                      num_rows=game_settings['numRows'],
+                      num_cards_in_deck=game_settings['numCardsInDeck'],
+                      max_cards_in_hand=game_settings['maxCardsInHand'],
+                      xth_card_takes=game_settings['XthCardTakes'],
+                      immutable_percepts=game_settings['immutablePercepts'])
+      start = time.time()
+      record(args.output, settings, args.agents, args.games, args.seed, args.depth)
+      print("Recorded %d games to %s in %s" % (args.games, args.output, time_to_str(time.time() - start)))
+   else:
+      report = check(args.replay, agentFile=args.agent, seat=args.seat)
+      print("Replayed %d moves of %s to %s" % (report["moves"], report["replay"], report["agent"]))
+      print("  Different decisions: %d" % len(report["differences"]))
+      for difference in report["differences"][:10]:
+         print("    game %d, %d cards in hand: recorded %d, replayed %d" %
+               (difference["game"], difference["hand_size"], difference["recorded"], difference["replayed"]))
+      print("  Time per move: mean %.3f ms -> %.3f ms, p99 %.3f ms -> %.3f ms, median ratio %.2f" %
+            (report["mean_ms"][0], report["mean_ms"][1], report["p99_ms"][0], report["p99_ms"][1],
+             report["median_time_ratio"]))
+      if args.output:
+         with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+      sys.exit(1 if report["differences"] else 0)
@@ -0,0 +1,107 @@
+__author__ = "Cam Clark"
+__organization__ = "COSC343/AIML402, University of Otago"
+__email__ = "claca067@student.otago.ac.nz"
+
+# Streaming per-game results for XNimmtGame.run. With a results file every finished game is
+# appended as one JSON line, so a long run that stops half way keeps what it played and is
+# picked up from the last complete game when run again with the same file:
+#
+#    game.run(agentFiles=..., num_games=10000, seed=1, results_file="results.jsonl")
+#
+# The first line is a header with the run's seed, agents and game settings; a file written by
+# a different run is refused rather than mixed in. Each game line holds
+#
+#    {"game": index, "seed": agent random seed, "deck": crc32 of the deck order,
+#     "scores": [per-player score], "time": seconds}
+#
+# so the results can be loaded later (read_results) and any game replayed from its index.
+
+import json
+import os
+import time
+import zlib
+
+
+def deck_id(deck_indices):
+   """Short id of a deck order, to check a replayed or resumed game got the same deck"""
+   return "%08x" % zlib.crc32(",".join(str(int(i)) for i in deck_indices).encode())
+
+
+def read_results(path):
+   """Returns (header, list of game records) of a results file, ignoring a cut off last line"""
+   header = None
+   records = []
+   with open(path) as f:
+      for line in f:
+         if not line.endswith("\n"):
+            break # the run stopped in the middle of writing this line
+         entry = json.loads(line)
+         if header is None:
+            header = entry["header"]
+         else:
+            records.append(entry)
+   return header, records
+
+
+class ResultsSink:
+   """Appends one line per game to a JSONL file, flushed every flush_every games or
+   flush_seconds seconds (and on close)
+
+   :param header: dict describing the run, a file that exists must have been written with the same
+   """
+
+   def __init__(self, path, header, flush_every=100, flush_seconds=5.0):
+      self.path = path
+      self.header = header
+      self.flush_every = flush_every
+      self.flush_seconds = flush_seconds
+      self.records = [] # games already in the file when resuming
+      self.pending = 0
+      self.last_flush = time.time()
+
+      if os.path.exists(path) and os.path.getsize(path) > 0:
+         old_header, self.records = read_results(path)
+         if old_header != json.loads(json.dumps(header)):
+            raise RuntimeError("Error! Results file '%s' was written by a different run (%s)" % (path, old_header))
+         for n, record in enumerate(self.records):
+            if record["game"] != n:
+               raise RuntimeError("Error! Results file '%s' is missing game %d" % (path, n))
+         # Drop a cut off last line before appending
+         with open(path) as f:
+            size = sum(len(line.encode()) for line in f if line.endswith("\n"))
+         self.file = open(path, "r+")
+         self.file.truncate(size)
+         self.file.seek(size)
+      else:
+         self.file = open(path, "w")
+         self.file.write(json.dumps({"header": header}) + "\n")
+         self.file.flush()
+
+   def check_decks(self, all_decks):
+      """Refuses the file if a game already in it was played with another deck than the run deals"""
+      for record, deck_indices in zip(self.records, all_decks):
+         if record["deck"] != deck_id(deck_indices):
+            raise RuntimeError("Error! Results file '%s' has game %d with a different deck" % (self.path, record["game"]))
+
+   @property
+   def num_done(self):
+      """Number of games already in the file, the run continues from this game index"""
+      return len(self.records)
+
+   def write(self, game_index, game_seed, deck_indices, scores, game_time):
+      self.file.write(json.dumps({"game": game_index, "seed": int(game_seed), "deck": deck_id(deck_indices),
+                                  "scores": [float(s) for s in scores], "time": game_time}) + "\n")
+      self.pending += 1
+      if self.pending >= self.flush_every or time.time() - self.last_flush > self.flush_seconds:
+         self.flush()
+
+   def flush(self):
+      self.file.flush()
+      os.fsync(self.file.fileno())
+      self.pending = 0
+      self.last_flush = time.time()
+
+   def close(self):
+      if not self.file.closed:
+         self.flush()
+         self.file.close()
@@ -0,0 +1,256 @@
+__author__ = "Cam Clark"
+__organization__ = "COSC343/AIML402, University of Otago"
+__email__ = "claca067@student.otago.ac.nz"
+
+# Self-play data for fitting evaluators. Plays seeded games without any output, on several
+# processes, and writes every decision an agent made as one record:
+#
+#    game, player, cards in hand, hand, row tops, row lengths, row points, cards seen so far,
+#    card played, the player's final score in the game
+#
+# e.g.
+#
+#    python selfplay.py --games 100000 --workers 4 --output selfplay_data
+#    python selfplay.py --games 100000 --workers 4 --output selfplay_data --seed 2   # adds more
+#
+# Data is kept in shards, one directory per batch of games (shard_00000, shard_00001, ...),
+# each with a meta.json and one raw fixed-width binary file per column. Columns are appended to
+# as games finish, so nothing is held in memory beyond a write buffer, and read back as
+# memory-mapped arrays without loading them (open_dataset). Running again on the same output
+# adds new shards after the existing ones; the game settings have to match.
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+from settings import game_settings
+from xnimmt import XNimmtGame, Player, time_to_str
+from instrumentation import Instrumentation
+
+
+def shard_columns(settings):
+   """(name, dtype, shape of one record) of every column for the game settings"""
+   num_rows = settings["num_rows"]
+   seen_bytes = (settings["num_cards_in_deck"] + 1 + 7) // 8
+   return [("game", "<u4", ()),
+           ("player", "u1", ()),
+           ("hand_size", "u1", ()),
+           ("hand", "u1", (settings["max_cards_in_hand"],)),  # card numbers ascending, 0 padded
+           ("row_tops", "u1", (num_rows,)),
+           ("row_lengths", "u1", (num_rows,)),
+           ("row_points", "<u2", (num_rows,)),
+           ("seen", "u1", (seen_bytes,)),  # np.packbits of a card number indexed mask
+           ("action", "u1", ()),
+           ("final_score", "<f4", ())]
+
+
+class ShardWriter:
+   """Appends records to the column files of one shard, buffer_size records at a time"""
+
+   def __init__(self, path, settings, meta, buffer_size=65536):
+      if settings["num_cards_in_deck"] > 255:
+         raise RuntimeError("Error! Self-play records store card numbers in one byte, decks of up to 255 cards")
+      self.path = path
+      self.columns = shard_columns(settings)
+      self.buffer_size = buffer_size
+      self.buffers = {name: [] for name, dtype, shape in self.columns}
+      self.num_records = 0
+      os.makedirs(path, exist_ok=True)
+      meta = dict(meta, settings=settings,
+                  columns=[{"name": name, "dtype": dtype, "shape": list(shape)} for name, dtype, shape in self.columns])
+      with open(os.path.join(path, "meta.json"), "w") as f:
+         json.dump(meta, f, indent=1)
+
+   def add(self, **record):
+      for name, values in self.buffers.items():
+         values.append(record[name])
+      self.num_records += 1
+      if len(self.buffers["game"]) >= self.buffer_size:
+         self.flush()
+
+   def flush(self):
+      if not self.buffers["game"]:
+         return
+      for name, dtype, shape in self.columns:
+         array = np.asarray(self.buffers[name], dtype=dtype)
+         with open(os.path.join(self.path, name + ".bin"), "ab") as f:
+            f.write(array.tobytes())
+         self.buffers[name] = []
+
+   def close(self, **meta):
+      """Flushes the buffer and marks the shard complete"""
+      self.flush()
+      meta_path = os.path.join(self.path, "meta.json")
+      with open(meta_path) as f:
+         full_meta = json.load(f)
+      full_meta.update(meta, num_records=self.num_records, complete=True)
+      with open(meta_path, "w") as f:
+         json.dump(full_meta, f, indent=1)
+
+
+def open_shard(path):
+   """Columns of a shard as read-only memory-mapped arrays, (meta, dict of name -> array)"""
+   with open(os.path.join(path, "meta.json")) as f:
+      meta = json.load(f)
+   columns = {}
+   for column in meta["columns"]:
+      dtype = np.dtype(column["dtype"])
+      shape = tuple(column["shape"])
+      file_path = os.path.join(path, column["name"] + ".bin")
+      record_size = dtype.itemsize * int(np.prod(shape, dtype=int))
+      num_records = os.path.getsize(file_path) // record_size if os.path.exists(file_path) else 0
+      if num_records == 0:
+         columns[column["name"]] = np.zeros((0,) + shape, dtype=dtype)
+      else:
+         columns[column["name"]] = np.memmap(file_path, dtype=dtype, mode="r", shape=(num_records,) + shape)
+   return meta, columns
+
+
+def shard_paths(directory):
+   return sorted(glob.glob(os.path.join(directory, "shard_*")))
+
+
+def open_dataset(directory, complete_only=True):
+   """All the shards in directory as a list of (meta, columns), see open_shard"""
+   shards = [open_shard(path) for path in shard_paths(directory)]
+   if complete_only:
+      shards = [(meta, columns) for meta, columns in shards if meta.get("complete")]
+   return shards
+
+
+class SelfPlayRecorder(Instrumentation):
+   """Instrumentation that keeps every decision of a game and writes them to a ShardWriter
+   with the player's final score when the game ends"""
+
+   def __init__(self, writer, num_cards_in_deck, max_cards_in_hand):
+      super().__init__(keep_moves=False)
+      self.writer = writer
+      self.num_cards_in_deck = num_cards_in_deck
+      self.max_cards_in_hand = max_cards_in_hand
+      self.game_id = None
+      self.decisions = []
+      self.public = None # cards every player has seen, on the table or played in a finished trick
+      self.trick_cards = []
+      self.hand_size = None
+
+   def begin_game(self, players):
+      super().begin_game(players)
+      self.decisions = []
+      self.public = np.zeros(self.num_cards_in_deck + 1, dtype=bool)
+      self.trick_cards = []
+      self.hand_size = None
+
+   def record_move(self, p, player, percepts, action, elapsed, counters):
+      hand, table = percepts
+      if len(hand) != self.hand_size:
+         # A new trick, the cards played in the last one have been seen by everyone
+         for card in self.trick_cards:
+            self.public[card] = True
+         self.trick_cards = []
+         self.hand_size = len(hand)
+      self.trick_cards.append(action)
+      for row in table:
+         for n, value in row:
+            self.public[n] = True
+
+      seen = self.public.copy()
+      for n, value in hand:
+         seen[n] = True
+      self.decisions.append(dict(player=p, hand_size=len(hand), hand=[n for n, value in hand],
+                                 row_tops=[row[-1][0] for row in table], row_lengths=[len(row) for row in table],
+                                 row_points=[sum(value for n, value in row) for row in table],
+                                 seen=np.packbits(seen, bitorder="little"), action=action))
+
+   def end_game(self, scores):
+      super().end_game(scores)
+      for decision in self.decisions:
+         hand = decision["hand"]
+         decision["hand"] = sorted(hand) + [0] * (self.max_cards_in_hand - len(hand))
+         self.writer.add(game=self.game_id, final_score=scores[decision["player"]], **decision)
+      self.decisions = []
+
+
+def play_shard(task):
+   """Plays the games of one shard and writes them, runs in a worker process"""
+   settings, agentFiles, depth, shard_path, shard_index, num_games, seed, first_game = task
+   game = XNimmtGame(verbose=0, **settings)
+   players = [Player(game=game, playerFile=agentFile) for agentFile in agentFiles]
+   for player in players:
+      if hasattr(player.agent, 'fixed_depth'):
+         player.agent.fixed_depth(depth)
+
+   writer = ShardWriter(shard_path, settings, {"shard": shard_index, "agents": list(agentFiles), "depth": depth,
+                                               "seed": seed, "first_game": first_game, "complete": False})
+   recorder = SelfPlayRecorder(writer, game.num_cards_in_deck, game.max_cards_in_hand)
+   game.instrument = recorder
+
+   start = time.time()
+   all_decks, game_seeds = game.deal_decks(num_games, seed)
+   for n in range(num_games):
+      recorder.game_id = first_game + n
+      game.play_seeded(players, all_decks[n].tolist(), game_seeds[n])
+   writer.close(num_games=num_games, time=time.time() - start)
+   return shard_index, writer.num_records
+
+
+def generate(directory, settings, agentFiles, num_games, games_per_shard=10000, depth=2, seed=1, num_workers=1):
+   """Plays num_games games into new shards of directory
+
+   :return: number of records written
+   """
+   os.makedirs(directory, exist_ok=True)
+   existing = open_dataset(directory, complete_only=False)
+   for meta, columns in existing:
+      if meta["settings"] != json.loads(json.dumps(settings)):
+         raise RuntimeError("Error! '%s' holds data for different game settings %s" % (directory, meta["settings"]))
+   first_shard = len(shard_paths(directory))
+   first_game = sum(meta.get("num_games", 0) for meta, columns in existing)
+
+   tasks = []
+   for i, start in enumerate(range(0, num_games, games_per_shard)):
+      shard_index = first_shard + i
+      shard_games = min(games_per_shard, num_games - start)
+      # Every shard of every run gets its own decks
+      shard_seed = (seed * 1000003 + shard_index) % (2**32)
+      tasks.append((settings, list(agentFiles), depth, os.path.join(directory, "shard_%05d" % shard_index),
+                    shard_index, shard_games, shard_seed, first_game + start))
+
+   num_records = 0
+   if num_workers > 1 and len(tasks) > 1:
+      with multiprocessing.Pool(processes=min(num_workers, len(tasks))) as pool:
+         for shard_index, shard_records in pool.imap_unordered(play_shard, tasks):
+            num_records += shard_records
+            print("  shard %d: %d positions" % (shard_index, shard_records))
+   else:
+      for task in tasks:
+         shard_index, shard_records = play_shard(task)
+         num_records += shard_records
+         print("  shard %d: %d positions" % (shard_index, shard_records))
+   return num_records
+
+
+if __name__ == "__main__":
+
+   parser = argparse.ArgumentParser(description="Write self-play positions, moves and outcomes for fitting evaluators")
+   parser.add_argument("--games", type=int, default=10000, help="number of games to play")
+   parser.add_argument("--agents", nargs="+", default=list(game_settings['players']), help="agent files, one per player")
+   parser.add_argument("--depth", type=int, default=2, help="fixed search depth for agents that search")
+   parser.add_argument("--games-per-shard", type=int, default=10000, help="games in one shard")
+   parser.add_argument("--workers", type=int, default=game_settings['numWorkers'], help="number of processes")
+   parser.add_argument("--seed", type=int, default=game_settings['seed'], help="seed for the decks")
+   parser.add_argument("--output", default="selfplay_data", help="directory for the shards")
+   args = parser.parse_args()
+
+   settings = dict(num_players=len(args.agents),
+                   num_rows=game_settings['numRows'],
+                   num_cards_in_deck=game_settings['numCardsInDeck'],
+                   max_cards_in_hand=game_settings['maxCardsInHand'],
+                   xth_card_takes=game_settings['XthCardTakes'])
+
+   start = time.time()
+   num_records = generate(args.output, settings, args.agents, args.games, games_per_shard=args.games_per_shard,
+                          depth=args.depth, seed=args.seed, num_workers=args.workers)
+   print("Wrote %d positions from %d games to %s in %s" % (num_records, args.games, args.output, time_to_str(time.time() - start)))
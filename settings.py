@@ -24,7 +24,20 @@ game_settings = {
                                 # 0 - no output, 1 - summary of the game, 
                                 # 2 - detailed output   
 
-   "seed": 1                  # seed for random choices of bids in the game, None for random seed
+   "seed": 1,                 # seed for random choices of bids in the game, None for random seed
+
+   "immutablePercepts": False,  # pass agents read-only tuples instead of copies of the hand
+                                # and table (faster, agents that change them raise an error)
+
+   "numWorkers": 1,             # number of processes to play the games on, results are the
+                                # same as with 1 for a given seed as long as the agents don't
+                                # depend on the clock or learn across games (my_agent.py counts
+                                # its time budget in nodes when seeded); verbose level 2 output
+                                # is only shown with 1
+
+   "resultsFile": None          # JSONL file to append every game's result to as it finishes,
+                                # a run with the same file and settings continues where it
+                                # stopped, None for no file
 
 }
 
@@ -38,8 +51,11 @@ if __name__ == "__main__":
                     num_cards_in_deck=game_settings['numCardsInDeck'],
                     max_cards_in_hand=game_settings['maxCardsInHand'],
                     xth_card_takes=game_settings['XthCardTakes'],
-                    verbose=game_settings['verboseLevel'])
+                    verbose=game_settings['verboseLevel'],
+                    immutable_percepts=game_settings['immutablePercepts'])
    
    game.run(agentFiles=game_settings['players'],
             num_games=game_settings['totalNumberOfGames'],
-            seed=game_settings['seed'])
\ No newline at end of file
+            seed=game_settings['seed'],
+            num_workers=game_settings['numWorkers'],
+            results_file=game_settings['resultsFile'])
\ No newline at end of file
@@ -0,0 +1,247 @@
+__author__ = "Cam Clark"
+__organization__ = "COSC343/AIML402, University of Otago"
+__email__ = "claca067@student.otago.ac.nz"
+
+# Round-robin tournament between all the agents in a directory, e.g.
+#
+#    python tournament.py tournament/ --games 500 --workers 4
+#
+# Agents are either .py files directly in the directory or one .py file per sub-directory
+# (tournament/<name>/my_agent.py, named after the sub-directory as in XNimmtGame's tournament
+# mode). Every seating of different agents plays the same seeded decks, with the deck
+# configuration from settings.py. The result of each seating is cached on disk under the hash
+# of the agents' files, the engine and the settings, so after changing one agent only the
+# seatings it is in are played again.
+
+import argparse
+import glob
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from settings import game_settings
+from xnimmt import XNimmtGame, Player, ScoreTotals, make_reproducible, time_to_str
+
+
+def find_agents(directory):
+   """Agent files in directory and its sub-directories, those that define XNimmtAgent"""
+   agents = []
+   for path in sorted(glob.glob(os.path.join(directory, "*.py")) + glob.glob(os.path.join(directory, "*", "*.py"))):
+      with open(path) as f:
+         if "class XNimmtAgent" in f.read():
+            agents.append(os.path.abspath(path))
+   return agents
+
+
+def agent_names(agentFiles):
+   """Short names for the standings: the file name, or the sub-directory name for agents that
+   share a file name (tournament/<name>/my_agent.py)"""
+   base_names = [os.path.basename(agentFile)[:-3] for agentFile in agentFiles]
+   names = {}
+   for agentFile, base_name in zip(agentFiles, base_names):
+      if base_names.count(base_name) > 1:
+         names[agentFile] = os.path.basename(os.path.dirname(agentFile))
+      else:
+         names[agentFile] = base_name
+   return names
+
+
+def file_hash(path):
+   with open(path, "rb") as f:
+      return hashlib.sha256(f.read()).hexdigest()
+
+
+def seating_key(agent_hashes, settings, num_games, seed, engine_hash):
+   """Cache key of one seating, changes whenever anything that can change its result does"""
+   text = json.dumps({"agents": list(agent_hashes), "settings": settings, "games": num_games,
+                      "seed": seed, "engine": engine_hash}, sort_keys=True)
+   return hashlib.sha256(text.encode()).hexdigest()
+
+
+def failing_agent(error, agentFiles):
+   """The agent file an error in a game came from, None if it can't be told"""
+   message = str(error)
+   for agentFile in agentFiles:
+      if agentFile in message: # a card that's not in the hand, or a file that didn't load
+         return agentFile
+   # An exception the agent raised is re-raised by the game, look for the agent's code in it
+   cause = error.__context__ or error.__cause__
+   tb = cause.__traceback__ if cause is not None else error.__traceback__
+   while tb is not None:
+      if tb.tb_frame.f_code.co_filename in agentFiles:
+         return tb.tb_frame.f_code.co_filename
+      tb = tb.tb_next
+   return None
+
+
+def play_seating(task):
+   """Plays the seeded games of one seating, runs in a worker process. An agent that fails to
+   load, raises or plays a card it doesn't have stops the seating, the result then has the
+   error and the totals of the games finished before it."""
+   settings, agentFiles, num_games, seed = task
+   # Not the game's tournament mode, it records an agent's error and carries on with the card
+   # still in the agent's hand, so the game never ends; here the error is raised
+   game = XNimmtGame(verbose=0, **settings)
+   totals = ScoreTotals(game.num_players)
+   error = None
+   error_agent = None
+   try:
+      players = [Player(game=game, playerFile=agentFile) for agentFile in agentFiles]
+      make_reproducible(players) # cached results have to be the ones any rerun would give
+      all_decks, game_seeds = game.deal_decks(num_games, seed)
+      for n in range(num_games):
+         totals.add(*game.play_seeded(players, all_decks[n].tolist(), game_seeds[n]))
+   except Exception as e:
+      error = "Game %d: %s" % (totals.num_games + 1, e)
+      error_agent = failing_agent(e, agentFiles)
+
+   return {"agents": list(agentFiles), "scores": totals.scores.tolist(), "win_counts": totals.win_counts.tolist(),
+           "draw_count": totals.draw_count, "num_games": totals.num_games, "time": totals.time,
+           "error": error, "error_agent": error_agent}
+
+
+class Tournament:
+   """Plays every seating of the agents and keeps the results in cache_dir
+
+   :param agentFiles: paths of the agent files
+   :param settings: XNimmtGame arguments other than verbose and tournament
+   """
+
+   def __init__(self, agentFiles, settings, num_games=100, seed=1, cache_dir=".tournament_cache"):
+      self.agentFiles = list(agentFiles)
+      self.settings = dict(settings)
+      self.num_games = num_games
+      self.seed = seed
+      self.cache_dir = cache_dir
+      self.engine_hash = file_hash(os.path.join(os.path.dirname(os.path.realpath(__file__)), "xnimmt.py"))
+      self.hashes = {agentFile: file_hash(agentFile) for agentFile in self.agentFiles}
+      self.names = agent_names(self.agentFiles)
+
+   def seatings(self):
+      return list(itertools.permutations(self.agentFiles, self.settings["num_players"]))
+
+   def cache_path(self, seating):
+      key = seating_key([self.hashes[agentFile] for agentFile in seating], self.settings,
+                        self.num_games, self.seed, self.engine_hash)
+      return os.path.join(self.cache_dir, key + ".json")
+
+   def load_cached(self, seating):
+      path = self.cache_path(seating)
+      if not os.path.exists(path):
+         return None
+      with open(path) as f:
+         return json.load(f)
+
+   def store(self, seating, result):
+      os.makedirs(self.cache_dir, exist_ok=True)
+      path = self.cache_path(seating)
+      tmp_path = path + ".tmp"
+      with open(tmp_path, "w") as f:
+         json.dump(result, f)
+      os.replace(tmp_path, path)
+
+   def finished(self, seating, result, verbose):
+      self.store(seating, result)
+      if verbose:
+         names = " vs ".join(self.names[agentFile] for agentFile in seating)
+         if result["error"] is not None:
+            culprit = self.names[result["error_agent"]] if result["error_agent"] is not None else "unknown agent"
+            print("  %s: stopped after %d games, %s: %s" % (names, result["num_games"], culprit, result["error"]))
+         else:
+            print("  %s: %s" % (names, " ".join("%.2f" % (s / result["num_games"]) for s in result["scores"])))
+
+   def run(self, num_workers=1, verbose=True):
+      """Plays the seatings missing from the cache and returns the results of all of them"""
+      results = {}
+      todo = []
+      for seating in self.seatings():
+         cached = self.load_cached(seating)
+         if cached is None:
+            todo.append(seating)
+         else:
+            results[seating] = cached
+
+      if verbose:
+         print("Tournament: %d agents, %d seatings, %d cached, %d to play" %
+               (len(self.agentFiles), len(results) + len(todo), len(results), len(todo)))
+
+      start = time.time()
+      tasks = [(self.settings, seating, self.num_games, self.seed) for seating in todo]
+      if num_workers > 1 and len(tasks) > 1:
+         with multiprocessing.Pool(processes=min(num_workers, len(tasks))) as pool:
+            for seating, result in zip(todo, pool.imap(play_seating, tasks)):
+               self.finished(seating, result, verbose)
+               results[seating] = result
+      else:
+         for seating, task in zip(todo, tasks):
+            result = play_seating(task)
+            self.finished(seating, result, verbose)
+            results[seating] = result
+
+      if verbose and todo:
+         print("Played in %s" % time_to_str(time.time() - start))
+      return results
+
+   def standings(self, results):
+      """Per-agent totals over all its seatings, best average score first and agents without a
+      finished game last. A seating stopped by an error counts the games finished before it,
+      and the error against the agent it came from (every agent in it if that isn't known)."""
+      table = {agentFile: {"agent": agentFile, "name": self.names[agentFile], "games": 0, "score": 0.0, "wins": 0, "draws": 0,
+                           "errors": 0} for agentFile in self.agentFiles}
+      for seating, result in results.items():
+         for i, agentFile in enumerate(seating):
+            entry = table[agentFile]
+            if result.get("error") is not None and result.get("error_agent") in (None, agentFile):
+               entry["errors"] += 1
+            entry["games"] += result["num_games"]
+            entry["score"] += result["scores"][i]
+            entry["wins"] += result["win_counts"][i]
+            entry["draws"] += result["draw_count"]
+      standings = list(table.values())
+      for entry in standings:
+         entry["average_score"] = entry["score"] / max(1, entry["games"])
+         entry["win_rate"] = entry["wins"] / max(1, entry["games"])
+      standings.sort(key=lambda entry: (entry["games"] == 0, -entry["average_score"]))
+      return standings
+
+
+if __name__ == "__main__":
+
+   parser = argparse.ArgumentParser(description="Round-robin X Nimmt! tournament between the agents in a directory")
+   parser.add_argument("directory", help="directory with the agent files")
+   parser.add_argument("--games", type=int, default=game_settings['totalNumberOfGames'], help="games per seating")
+   parser.add_argument("--seed", type=int, default=game_settings['seed'], help="seed for the shared decks")
+   parser.add_argument("--workers", type=int, default=game_settings['numWorkers'], help="number of seatings played at once")
+   parser.add_argument("--cache", default=".tournament_cache", help="directory for the cached seating results")
+   parser.add_argument("--output", help="write the standings and seating results as JSON to this file")
+   args = parser.parse_args()
+
+   agentFiles = find_agents(args.directory)
+   num_players = len(game_settings['players'])
+   if len(agentFiles) < num_players:
+      raise RuntimeError("Error! Need at least %d agents in '%s', found %d" % (num_players, args.directory, len(agentFiles)))
+
+   settings = dict(num_players=num_players,
+                   num_rows=game_settings['numRows'],
+                   num_cards_in_deck=game_settings['numCardsInDeck'],
+                   max_cards_in_hand=game_settings['maxCardsInHand'],
+                   xth_card_takes=game_settings['XthCardTakes'],
+                   immutable_percepts=game_settings['immutablePercepts'])
+
+   tournament = Tournament(agentFiles, settings, num_games=args.games, seed=args.seed, cache_dir=args.cache)
+   results = tournament.run(num_workers=args.workers)
+   standings = tournament.standings(results)
+
+   print("\n === Standings ===")
+   for rank, entry in enumerate(standings):
+      print("  %d. %s: average score %.2f, %d wins in %d games (%.1f%%)" %
+            (rank + 1, entry["name"], entry["average_score"], entry["wins"], entry["games"], 100 * entry["win_rate"]))
+      if entry["errors"]:
+         print("     %d seatings stopped by an error" % entry["errors"])
+
+   if args.output:
+      with open(args.output, "w") as f:
+         json.dump({"standings": standings,
+                    "seatings": [result for result in results.values()]}, f, indent=1)
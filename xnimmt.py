@@ -6,8 +6,11 @@ import os,sys
 import numpy as np
 import importlib.util
 import time
+import random
+import multiprocessing
+from bisect import bisect_left
 from settings import game_settings
-import copy
+from results import ResultsSink, read_results
 
 def time_to_str(time_in_seconds):
    timeStr = ''
@@ -28,34 +31,205 @@ def time_to_str(time_in_seconds):
 
    return timeStr
 
-def table_resolve(table, card, xth_card_takes):
+def table_resolve_inplace(table, card, xth_card_takes):
+   """Places card on table without copying it.
 
-   table = copy.deepcopy(table)
+   :param table: list of rows, each a list of (card number, card value) tuples,
+                 changed in place
+   :param card: (card number, card value) tuple to place
+   :param xth_card_takes: the card that takes the row
+   :return: (points, row index, undo) where undo is a token for table_undo
+   """
    select_row = None
-   card_diff = np.inf
-   points = 0
+   card_diff = None
    for r, row in enumerate(table):
-      if row[-1][0] < card[0] and card[0] - row[-1][0] < card_diff:
+      if row[-1][0] < card[0] and (select_row is None or card[0] - row[-1][0] < card_diff):
          card_diff = card[0] - row[-1][0]
-         select_row = r 
+         select_row = r
 
    # Find the rows in the table that can take the card
    if select_row is not None:
       r = select_row
       if len(table[r]) < xth_card_takes:
          table[r].append(card)
-         return table, points, r
+         return 0, r, (r, None)
    else:
       # No rows available, find the row with the least points
-      r = np.argmin([sum(c[1] for c in row) for row in table])
+      row_points = [sum(c[1] for c in row) for row in table]
+      r = row_points.index(min(row_points))
 
-   for c in table[r]:
-      points -= c[1]
+   taken = table[r]
+   points = -sum(c[1] for c in taken)
    table[r] = [card]
-   
+
+   return points, r, (r, taken)
+
+def table_undo(table, undo):
+   """Reverts a single table_resolve_inplace call.
+
+   :param table: table that was passed to table_resolve_inplace
+   :param undo: the undo token it returned
+   """
+   r, taken = undo
+   if taken is None:
+      table[r].pop()
+   else:
+      table[r] = taken
+
+def table_resolve(table, card, xth_card_takes):
+
+   table = [list(row) for row in table]
+   points, r, _ = table_resolve_inplace(table, card, xth_card_takes)
    return table, points, r
 
 
+class Table:
+   """Rows of cards on the table that keep each row's length and points up to date, so
+   placing a card never has to look through the rows' cards.
+
+   The top cards are kept in ascending order (sorted_tops, order[i] is the row of
+   sorted_tops[i]) so the row a card goes on is found by bisection, and the row with the
+   least points is cached (None when the row it was grew, it is looked for again the next
+   time it is needed).
+
+   Iterating or indexing gives the rows as lists of (card number, card value) tuples,
+   as_lists() gives a copy in the list-of-lists form of the percepts and as_tuples()
+   a read-only tuple-of-tuples view that is only rebuilt after the table changes.
+   """
+
+   def __init__(self, rows):
+      self.rows = [list(row) for row in rows]
+      self.lengths = [len(row) for row in self.rows]
+      self.points = [sum(c[1] for c in row) for row in self.rows]
+      self.order = sorted(range(len(self.rows)), key=lambda r: self.rows[r][-1][0])
+      self.sorted_tops = [self.rows[r][-1][0] for r in self.order]
+      self.least = self.points.index(min(self.points)) if self.rows else None
+      self.view = None
+
+   def __len__(self):
+      return len(self.rows)
+
+   def __iter__(self):
+      return iter(self.rows)
+
+   def __getitem__(self, r):
+      return self.rows[r]
+
+   @property
+   def tops(self):
+      """Top card number of every row"""
+      return [row[-1][0] for row in self.rows]
+
+   def as_lists(self):
+      return [list(row) for row in self.rows]
+
+   def as_tuples(self):
+      if self.view is None:
+         self.view = tuple(tuple(row) for row in self.rows)
+      return self.view
+
+   def least_points_row(self):
+      # First row on a tie, same as np.argmin
+      if self.least is None:
+         self.least = self.points.index(min(self.points))
+      return self.least
+
+   def resolve(self, card, xth_card_takes):
+      """Same as table_resolve_inplace for this table
+
+      :return: (points, row index, undo) where undo is a token for Table.undo
+      """
+      number = card[0]
+      sorted_tops = self.sorted_tops
+      i = bisect_left(sorted_tops, number) # rows order[:i] have smaller tops
+      least = self.least
+      points = self.points
+      self.view = None
+
+      if i:
+         # The closest smaller top, the row keeps its place in the order with card on top
+         i -= 1
+         r = self.order[i]
+         sorted_tops[i] = number
+         lengths = self.lengths
+         if lengths[r] < xth_card_takes:
+            self.rows[r].append(card)
+            lengths[r] += 1
+            points[r] += card[1]
+            if r == least:
+               self.least = None
+            return 0, r, (r, None, 0, least, i)
+      else:
+         # Lower than every top, the least points row is taken and goes to the front
+         if least is None:
+            least = self.least = points.index(min(points))
+         r = least
+         order = self.order
+         i = order.index(r)
+         del order[i]
+         del sorted_tops[i]
+         order.insert(0, r)
+         sorted_tops.insert(0, number)
+         i = -1 - i # negative marks a move to the front for undo
+
+      taken_points = points[r]
+      taken = self.rows[r]
+      self.rows[r] = [card]
+      self.lengths[r] = 1
+      points[r] = card[1]
+      if r == least:
+         self.least = None
+      elif least is not None and (card[1] < points[least] or (card[1] == points[least] and r < least)):
+         self.least = r
+      return -taken_points, r, (r, taken, taken_points, least, i)
+
+   def undo(self, undo):
+      """Reverts a single Table.resolve call"""
+      r, taken, points, least, i = undo
+      self.view = None
+      if taken is None:
+         card = self.rows[r].pop()
+         self.lengths[r] -= 1
+         self.points[r] -= card[1]
+      else:
+         self.rows[r] = taken
+         self.lengths[r] = len(taken)
+         self.points[r] = points
+      top = self.rows[r][-1][0]
+      if i < 0:
+         i = -1 - i
+         del self.order[0]
+         del self.sorted_tops[0]
+         self.order.insert(i, r)
+         self.sorted_tops.insert(i, top)
+      else:
+         self.sorted_tops[i] = top
+      self.least = least
+
+
+class ScoreTotals:
+   """Running totals over games: summed scores, wins of each player and draws (games where
+   more than one player has the best score)"""
+
+   def __init__(self, num_players):
+      self.scores = np.zeros((num_players))
+      self.win_counts = np.zeros((num_players), dtype='int')
+      self.draw_count = 0
+      self.num_games = 0
+      self.time = 0
+
+   def add(self, game_score, game_time):
+      self.scores += game_score
+      best = np.max(game_score)
+      winners = [i for i, s in enumerate(game_score) if abs(s - best) < 1e-9]
+      if len(winners) == 1:
+         self.win_counts[winners[0]] += 1
+      else:
+         self.draw_count += 1
+      self.num_games += 1
+      self.time += game_time
+
+
 # Class player is a wrapper for a player agent
 class Player:
    def __init__(self, game, playerFile, jointname=False):
@@ -95,6 +269,10 @@ class Player:
       except Exception as e:
          raise RuntimeError(str(e))
 
+      # Agents that search over the other players' cards need to know how many there are
+      if hasattr(self.agent, 'num_players'):
+         self.agent.num_players = game.num_players
+
       if hasattr(self.exec, 'agentName') and self.exec.agentName[0] != '<':
          self.name = self.exec.agentName
       else:
@@ -109,7 +287,7 @@ class Player:
 
 class XNimmtGame:
 
-   def __init__(self,num_players, num_rows, num_cards_in_deck, max_cards_in_hand, xth_card_takes, verbose=0,tournament=False):
+   def __init__(self,num_players, num_rows, num_cards_in_deck, max_cards_in_hand, xth_card_takes, verbose=0,tournament=False,immutable_percepts=False):
 
       if num_players < 2:
          raise RuntimeError("Error! Number of players must be at least 2")
@@ -124,6 +302,15 @@ class XNimmtGame:
       self.xth_card_takes = xth_card_takes
       self.showTable = True
       self.autoPlayLastCard = True
+
+      # Constructor arguments, used to rebuild the game in worker processes
+      self.settings = dict(num_players=num_players, num_rows=num_rows, num_cards_in_deck=num_cards_in_deck,
+                           max_cards_in_hand=max_cards_in_hand, xth_card_takes=xth_card_takes, tournament=tournament,
+                           immutable_percepts=immutable_percepts)
+
+      # Pass agents read-only percepts (tuples) instead of copies of the hand and table,
+      # an agent that tries to change them fails with an error
+      self.immutable_percepts = immutable_percepts
       
 
       
@@ -143,6 +330,10 @@ class XNimmtGame:
 
       self.in_tournament = tournament
 
+      # Optional instrumentation.Instrumentation that times every AgentFunction call,
+      # only used by games played in this process
+      self.instrument = None
+
       self.verbose = verbose
       if tournament:
          self.throwError = self.errorAndReturn
@@ -186,6 +377,10 @@ class XNimmtGame:
          table[-1].append(deck[0])
          deck = deck[1:]
       table.sort(key=lambda x: x[0][0])  # Sort by card value
+      table = Table(table)
+
+      if self.instrument is not None:
+         self.instrument.begin_game(players)
 
       if self.verbose and self.showTable:
          print("\n  Table:")
@@ -201,11 +396,17 @@ class XNimmtGame:
 
          selected_cards = []      
          for p, player in enumerate(players):
-            percepts = (list(hands[p]), copy.deepcopy(table))
+            if self.immutable_percepts:
+               percepts = (tuple(hands[p]), table.as_tuples())
+            else:
+               percepts = (list(hands[p]), table.as_lists())
  
             try:
                if len(hands[p]) > 1 or not self.autoPlayLastCard:
-                  action = player.agent.AgentFunction(percepts)
+                  if self.instrument is None:
+                     action = player.agent.AgentFunction(percepts)
+                  else:
+                     action = self.instrument.call_agent(p, player, percepts)
                else:
                   action = hands[p][0][0]
             except Exception as e:
@@ -234,7 +435,7 @@ class XNimmtGame:
          selected_cards.sort(key=lambda x: x[1][0])
 
          for p, card in selected_cards:
-            table, points, r = table_resolve(table, card, self.xth_card_takes)
+            points, r, _ = table.resolve(card, self.xth_card_takes)
 
             if self.verbose > 1:
                if points == 0:
@@ -249,21 +450,66 @@ class XNimmtGame:
                for r, row in enumerate(table):
                   print(f"  {r+1}: {row}")
 
+      if self.instrument is not None:
+         self.instrument.end_game(scores)
+
       if self.verbose:
          print("")
       return scores
 
 
-   def run(self,agentFiles,num_games=1000,seed=None):
+   def deal_decks(self, num_games, seed):
+      """Returns the pre-shuffled deck (indices into self.deck) and the agent random seed for every game"""
+
+      rnd = np.random.RandomState(seed)
+
+      all_decks = np.zeros((num_games, len(self.deck))).astype('int')
+      for n in range(num_games):
+         all_decks[n] = rnd.choice(np.arange(len(self.deck)),size=len(self.deck),replace=False)
+
+      # Drawn after the decks so the decks for a seed stay the same as before
+      game_seeds = rnd.randint(0, 2**31-1, size=num_games)
+      return all_decks, game_seeds
+
+   def play_seeded(self, players, deck_indices, game_seed):
+      """Plays one game with the random generators agents may use seeded, so that a game
+      gives the same result whichever process plays it
+
+      :return: (game score, running time in seconds)
+      """
+      random.seed(int(game_seed))
+      np.random.seed(int(game_seed))
+      deck = [self.deck[i] for i in deck_indices]
+
+      start = time.time()
+      game_score = self.play(players,deck=deck)
+      end = time.time()
+      return game_score, end - start
+
+   def run(self,agentFiles,num_games=1000,seed=None,num_workers=1,results_file=None):
+      """Plays num_games games between the agents and prints the results
+
+      :param seed: seed for the decks and the agents' random generators; given, the agents are
+                   also made reproducible (see make_reproducible)
+      :param num_workers: number of processes to spread the games over; with more than one
+                          worker the per-trick output of verbose level 2 is not shown
+      :param results_file: JSONL file every finished game is appended to (see results.py); if it
+                           already has games of the same run, the run continues after them (with
+                           seed None, the seed of the run in the file)
+      :return: dict with the total scores, win counts and number of draws
+      """
 
       if self.verbose:
          print("Game play:")
          print("  Num rounds:       %d" % num_games)
 
+      # Only a seed given here asks for the same games and results on every run
+      reproducible = seed is not None
       if seed is None:
-         seed = int(time.time())
-
-      rnd = np.random.RandomState(seed)
+         if results_file is not None and os.path.exists(results_file) and os.path.getsize(results_file) > 0:
+            seed = read_results(results_file)[0]["seed"] # continue the run in the file with its seed
+         else:
+            seed = int(time.time())
 
       players = []
       for i, agentFile in enumerate(agentFiles):
@@ -272,62 +518,117 @@ class XNimmtGame:
             players.append(player)
          except Exception as e:
             self.throwError(str(e))
+      if reproducible:
+         make_reproducible(players)
             
-      win_counts = np.zeros((self.num_players), dtype='int')
-      draw_count = 0
+      all_decks, game_seeds = self.deal_decks(num_games, seed)
 
+      totals = ScoreTotals(self.num_players)
 
-      all_decks = np.zeros((num_games, len(self.deck))).astype('int')
-      for n in range(num_games):
-         all_decks[n] = rnd.choice(np.arange(len(self.deck)),size=len(self.deck),replace=False)
+      sink = None
+      if results_file is not None:
+         sink = ResultsSink(results_file, {"seed": seed, "num_games": num_games,
+                                           "agents": list(agentFiles), "settings": self.settings})
+         try:
+            sink.check_decks(all_decks)
+         except RuntimeError:
+            sink.close()
+            raise
+         # Games already played by an earlier run with this file count as played
+         for record in sink.records[:num_games]:
+            totals.add(np.array(record["scores"]), record["time"])
+         if totals.num_games == num_games:
+            print("All %d games already played in %s" % (num_games, results_file))
+         elif totals.num_games:
+            print("Resuming from game %d of %d in %s" % (totals.num_games + 1, num_games, results_file))
+      first_game = totals.num_games
+
+      pool = None
+      if num_workers > 1 and first_game < num_games:
+         pool = multiprocessing.Pool(processes=num_workers, initializer=_init_game_worker,
+                                     initargs=(self.settings, list(agentFiles), reproducible))
+         tasks = [(all_decks[n].tolist(), game_seeds[n]) for n in range(first_game, num_games)]
+         results = pool.imap(_play_worker_game, tasks, chunksize=max(1, len(tasks) // (num_workers * 8)))
+      else:
+         results = self._play_serial(players, all_decks, game_seeds, first_game)
 
-      score = np.zeros((self.num_players))
-      game_count = 0
-      tot_time = 0
-      for n in range(num_games):
-         deck = all_decks[n].tolist()
-         deck = [self.deck[i] for i in deck]
-         if self.verbose:
-            print("\nRound %d/%d" % (game_count+1,num_games))
-
-         start = time.time()
-         game_score = self.play(players,deck=deck)
-         end = time.time()
-         score += game_score
-         best = np.max(game_score)
-         winners = [i for i, s in enumerate(game_score) if abs(s - best) < 1e-9]
-         if len(winners) == 1:
-            win_counts[winners[0]] += 1
-         else:
-            draw_count += 1
-         game_count += 1
-         score_str = "  Score in game %d: " % game_count
-         for i in range(self.num_players):
-            score_str += "\n    Player %d (%s): %.2f" % (i+1, players[i].name, game_score[i])
-         print(score_str)
+      run_start = time.time()
+      try:
+         for game_score, game_time in results:
+            if sink is not None:
+               sink.write(totals.num_games, game_seeds[totals.num_games], all_decks[totals.num_games], game_score, game_time)
+            totals.add(game_score, game_time)
+            game_count = totals.num_games
+            score_str = "  Score in game %d: " % game_count
+            for i in range(self.num_players):
+               score_str += "\n    Player %d (%s): %.2f" % (i+1, players[i].name, game_score[i])
+            print(score_str)
  
-         score_str = "\nAverage score after game %d: " % game_count
-         for i in range(self.num_players):
-            score_str += "\n  Player %d (%s): %.2f" % (i+1, players[i].name, score[i]/game_count)
-         print(score_str)
-         tot_time += end - start
-
-         if game_count < num_games:
-            avg_time = tot_time / game_count
-            print("Average running time per game %s." % (time_to_str(avg_time)))
-            print("Time remaining %s." % (time_to_str(avg_time * (num_games-game_count))))
-            print("Expected total running time %s." % (time_to_str(avg_time * num_games)))
-         else:
-            print("Total running time %s." % (time_to_str(tot_time)))
+            score_str = "\nAverage score after game %d: " % game_count
+            for i in range(self.num_players):
+               score_str += "\n  Player %d (%s): %.2f" % (i+1, players[i].name, totals.scores[i]/game_count)
+            print(score_str)
+
+            if game_count < num_games:
+               if pool is None:
+                  avg_time = totals.time / game_count
+               else:
+                  # Games overlap in parallel, so estimate from the wall clock
+                  avg_time = (time.time() - run_start) / (game_count - first_game)
+               print("Average running time per game %s." % (time_to_str(avg_time)))
+               print("Time remaining %s." % (time_to_str(avg_time * (num_games-game_count))))
+               print("Expected total running time %s." % (time_to_str(avg_time * num_games)))
+            else:
+               print("Total running time %s." % (time_to_str(totals.time if pool is None else time.time() - run_start)))
+      finally:
+         if pool is not None:
+            pool.close()
+            pool.join()
+         if sink is not None:
+            sink.close()
+
+      game_count = totals.num_games
+      win_counts = totals.win_counts
+      draw_count = totals.draw_count
       print("\n === Win rate over %d games ===" % game_count)
       for i in range(self.num_players):
          wr = win_counts[i] / max(1, game_count)
          print(f"  Player {i+1} ({players[i].name}): {win_counts[i]} wins  ({wr:.1%})")
       if draw_count:
          print(f"  Draws: {draw_count} ({draw_count / max(1, game_count):.1%})")
-         
 
+      return {"scores": totals.scores, "win_counts": win_counts, "draw_count": draw_count, "num_games": game_count}
+
+   def _play_serial(self, players, all_decks, game_seeds, first_game=0):
+      for n in range(first_game, len(all_decks)):
+         if self.verbose:
+            print("\nRound %d/%d" % (n+1,len(all_decks)))
+         yield self.play_seeded(players, all_decks[n].tolist(), game_seeds[n])
+
+
+def make_reproducible(players):
+   """Asks agents that have a reproducible attribute (e.g. my_agent.py) to decide without the
+   clock, so a seeded game gives the same result in any process, on any machine and under any
+   load. Agents that don't have one are left as they are."""
+   for player in players:
+      if hasattr(player.agent, 'reproducible'):
+         player.agent.reproducible = True
+
+
+# Per-process state of the parallel runner, agents are loaded once per worker
+_worker_game = None
+_worker_players = None
+
+def _init_game_worker(settings, agentFiles, reproducible):
+   global _worker_game, _worker_players
+   _worker_game = XNimmtGame(verbose=0, **settings)
+   _worker_players = [Player(game=_worker_game, playerFile=agentFile) for agentFile in agentFiles]
+   if reproducible:
+      make_reproducible(_worker_players)
 
+def _play_worker_game(task):
+   deck_indices, game_seed = task
+   return _worker_game.play_seeded(_worker_players, deck_indices, game_seed)
 
 
 if __name__ == "__main__":
@@ -337,11 +638,14 @@ if __name__ == "__main__":
                     num_cards_in_deck=game_settings['numCardsInDeck'],
                     max_cards_in_hand=game_settings['maxCardsInHand'],
                     xth_card_takes=game_settings['XthCardTakes'],
-                    verbose=game_settings['verboseLevel'])
+                    verbose=game_settings['verboseLevel'],
+                    immutable_percepts=game_settings['immutablePercepts'])
    
    game.run(agentFiles=game_settings['players'],
             num_games=game_settings['totalNumberOfGames'],
-            seed=game_settings['seed'])
+            seed=game_settings['seed'],
+            num_workers=game_settings['numWorkers'],
+            results_file=game_settings['resultsFile'])
 
 
 